@@ -0,0 +1,522 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the patched string methods.
+
+Run it with `python benchmarks.py`. For every patched method it times the
+native implementation, the patched method called with plain arguments and
+the patched method called with a compiled pattern, over several string sizes,
+hit densities and string types:
+
+    $ python benchmarks.py --sizes 10 1000 100000 --json results.json
+    $ python benchmarks.py --baseline results.json --tolerance 1.25
+    $ python benchmarks.py --sizes 10 --import-time --max-import 50
+    $ python benchmarks.py --sizes 100000 --engines
+    $ python benchmarks.py --sizes 10 --threads 1 2 4 8
+    $ python benchmarks.py --sizes 10 --overhead
+
+The process exits with status 1 when the patched plain path is more than
+`--max-overhead` times slower than the native method, or when any timing is
+slower than the one recorded in the `--baseline` file by more than
+`--tolerance`.
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import timeit
+import argparse
+from itertools import islice
+from functools import reduce
+import subprocess
+
+import gorella
+
+# Overridden built-in methods and the arguments to call them with, `n` is the
+# needle (a plain string or a compiled pattern) and `s` the searched string.
+OVERRIDDEN = [
+    ('replace', 'n, x'),
+    ('split', 'n'),
+    ('rsplit', 'n'),
+    ('find', 'n'),
+    ('rfind', 'n'),
+    ('index', 'n'),
+    ('rindex', 'n'),
+    ('partition', 'n'),
+    ('rpartition', 'n'),
+    ('count', 'n'),
+    ('startswith', 'n'),
+    ('endswith', 'n'),
+]
+
+# Extension methods have no native counterpart, the baseline is the same
+# operation called on the compiled pattern and the plain path passes the
+# pattern source.
+EXTENSIONS = {
+    'match': ('p.match(s)', 's.match(n)', 's.match(p)'),
+    'search': ('p.search(s)', 's.search(n)', 's.search(p)'),
+    'findall': ('p.findall(s)', 's.findall(n)', 's.findall(p)'),
+    'finditer': ('list(p.finditer(s))', 'list(s.finditer(n))',
+                 'list(s.finditer(p))'),
+    'find_spans': ('[m.span() for m in p.finditer(s)]', 's.find_spans(n)',
+                   's.find_spans(p)'),
+    'search_any': ('p.search(s)', 's.search_any((n, n))',
+                   's.search_any((p, p))'),
+    'find_any': ('p.search(s).start()', 's.find_any((n, n))',
+                 's.find_any((p, p))'),
+    'grep': ('list(p.finditer(s))', 'list(s.grep(n))', 'list(s.grep(p))'),
+}
+
+SIZES = (10, 1000, 100000, 10 ** 7)
+DENSITIES = {'low': 1000, 'high': 10}
+
+# Values shared with the timeit setup code.
+_namespace = {}
+
+
+def best_of(stmt, number=None, repeat=3, **namespace):
+    _namespace.clear()
+    _namespace.update(namespace)
+    setup = ('import sys, gorella; '
+             'globals().update(sys.modules[%r]._namespace)' % __name__)
+    timer = timeit.Timer(stmt, setup)
+    if number is None:
+        # Aim at about 10ms per measurement.
+        number = max(1, min(100000, int(0.01 / max(timer.timeit(1), 1e-7))))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def make_text(size, gap, kind=str):
+    """Build a string of `size` characters with a hit every `gap` ones."""
+    block = '.' * max(gap - 2, 0) + 'ab'
+    text = (block * (size // len(block) + 1))[:max(size - 2, 0)] + 'ab'
+    return text if kind is str else kind(text.encode('ascii'))
+
+
+def string_types():
+    """The string types that are currently patched."""
+    return [t for t in (str, bytes, bytearray) if hasattr(t, '_c_find')]
+
+
+def cases(methods=None):
+    """Yield (method, native stmt, plain stmt, pattern stmt) tuples."""
+    methods = methods or gorella.methods_to_patch
+    for name, args in OVERRIDDEN:
+        if name in methods:
+            yield (name, 's._c_%s(%s)' % (name, args),
+                   's.%s(%s)' % (name, args),
+                   's.%s(%s)' % (name, args.replace('n', 'p', 1)))
+    for name in methods:
+        if name in EXTENSIONS:
+            yield (name,) + EXTENSIONS[name]
+
+
+def suite(sizes=SIZES, densities=DENSITIES, methods=None):
+    """Run the benchmark suite and return a list of result records."""
+    results = []
+    for kind in string_types():
+        needle, source = 'ab', 'a[b]'
+        if kind is not str:
+            needle, source = needle.encode(), source.encode()
+        pattern = re.compile(source)
+        for size in sizes:
+            for density, gap in sorted(densities.items()):
+                text = make_text(size, gap, kind)
+                for name, native, plain, patterned in cases(methods):
+                    namespace = {
+                        's': text, 'p': pattern, 'x': needle[:1],
+                        'n': pattern.pattern if name in EXTENSIONS
+                        else needle,
+                    }
+                    record = {'method': name, 'type': kind.__name__,
+                              'size': size, 'density': density}
+                    for column, stmt in (('native', native),
+                                         ('plain', plain),
+                                         ('pattern', patterned)):
+                        record[column] = best_of(stmt, **namespace)
+                    results.append(record)
+    return results
+
+
+def overhead(text='abc', number=200000):
+    """Return a list of (method, native seconds, patched seconds) tuples
+    for the overridden methods called with plain arguments.
+    """
+    results = []
+    for name, args in OVERRIDDEN:
+        native = best_of('s._c_%s(%s)' % (name, args), number,
+                         s=text, n='b', x='x')
+        patched = best_of('s.%s(%s)' % (name, args), number,
+                          s=text, n='b', x='x')
+        results.append((name, native, patched))
+    return results
+
+
+def tail_search(sizes=(10 ** 3, 10 ** 5, 10 ** 7), number=20):
+    """Return a list of (statement, size, seconds) tuples for the methods
+    that search from the end of a string with a pattern.
+    """
+    results = []
+    pattern = re.compile(r'\d{1,4}')
+    for size in sizes:
+        text = 'log line 42\n' * (size // 12)
+        for stmt in ('s.rfind(p)', 's.rpartition(p)', 's.rsplit(p, 2)'):
+            results.append((stmt, size,
+                            best_of(stmt, number, s=text, p=pattern)))
+    return results
+
+
+def suffix_check(sizes=(10 ** 3, 10 ** 6), number=20):
+    """Return a list of (pattern, size, seconds) tuples for `endswith` with
+    patterns of bounded and unbounded width.
+    """
+    results = []
+    for source in (r'\d{1,4}', r'id=\d+', r'[a-z]+=\d+'):
+        pattern = re.compile(source)
+        for size in sizes:
+            text = 'x' * (size - 7) + 'id=1234'
+            results.append((source, size, best_of(
+                's.endswith(p)', number, s=text, p=pattern)))
+    return results
+
+
+def available_engines(names=('re', 'literal', 'regex')):
+    """The engines among `names` that can be loaded."""
+    found = []
+    for name in names:
+        try:
+            gorella.get_engine(name)
+        except ImportError:
+            continue
+        found.append(name)
+    return found
+
+
+def backends(size=10 ** 5, methods=None):
+    """Return a list of (engine, method, density, seconds) tuples timing
+    the pattern path of the methods with a literal compiled by every
+    available engine.
+    """
+    results = []
+    for engine in available_engines():
+        pattern = gorella.compile('ab', engine=engine)
+        for density, gap in sorted(DENSITIES.items()):
+            text = make_text(size, gap)
+            for name, native, plain, patterned in cases(methods):
+                results.append((engine, name, density, best_of(
+                    patterned, s=text, p=pattern, x='a', n='ab')))
+    return results
+
+
+IMPORT_SCRIPT = (
+    'import re, sys, timeit; started = timeit.default_timer(); '
+    'import gorella; print(timeit.default_timer() - started)')
+
+
+def import_time(runs=10):
+    """Return a list of (GORELLA_PATCH value, seconds) tuples with the best
+    time of `import gorella` in a fresh interpreter, `re` being imported
+    already.
+    """
+    results = []
+    for value in ('1', '0'):
+        env = dict(os.environ, GORELLA_PATCH=value)
+        best = min(float(subprocess.check_output(
+            [sys.executable, '-c', IMPORT_SCRIPT], env=env))
+            for _ in range(runs))
+        results.append((value, best))
+    return results
+
+
+COLD_START_SCRIPT = (
+    'import sys, timeit; started = timeit.default_timer(); '
+    'import gorella; '
+    'patterns = [gorella.compile(p) for p in sys.stdin.read().split("\\n")]; '
+    'print(timeit.default_timer() - started)')
+
+
+def cold_start(count=5000, runs=5):
+    """Return a list of (pattern file, seconds) tuples with the best time
+    of importing gorella and compiling `count` patterns in a fresh
+    interpreter, without and with a saved pattern file.
+    """
+    import tempfile
+    patterns = [r'\b(?:key|name)%d\s*[:=]\s*(\d+|"[^"]*")' % i
+                for i in range(count)]
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        gorella.save_pattern_cache(path, patterns)
+        gorella.program_cache.close()
+        results = []
+        for value in ('', path):
+            env = dict(os.environ, GORELLA_PATTERN_FILE=value)
+            best = min(float(subprocess.Popen(
+                [sys.executable, '-c', COLD_START_SCRIPT], env=env,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE).communicate(
+                    '\n'.join(patterns).encode())[0])
+                for _ in range(runs))
+            results.append((bool(value), best))
+    finally:
+        os.remove(path)
+    return results
+
+
+def lazy_split(sizes=(10 ** 3, 10 ** 6), number=5):
+    """Return a list of (statement, size, seconds) tuples reading the first
+    or last fields of a record with the list and the lazy split methods.
+    """
+    results = []
+    pattern = re.compile(r'\s')
+    for size in sizes:
+        text = 'field one two three\n' * (size // 20)
+        for stmt in ('s.split(p)[:2]', 'list(islice(s.isplit(p), 2))',
+                     's.rsplit(p, 1)[-1]', 'next(s.irsplit(p))',
+                     's.rsplit(None, 1)[-1]', 'next(s.irsplit())'):
+            results.append((stmt, size, best_of(
+                stmt, number, s=text, p=pattern, islice=islice)))
+    return results
+
+
+def replace_rules(sizes=(10 ** 3, 10 ** 6), rules=30, number=5):
+    """Return a list of (statement, size, seconds) tuples applying a set of
+    literal rules one `replace` at a time and in a single pass.
+    """
+    results = []
+    table = dict(('word%02d' % i, 'WORD%02d' % i) for i in range(rules))
+    for size in sizes:
+        words = sorted(table) + ['other'] * rules
+        text = ' '.join(words[i % len(words)]
+                        for i in range(size // 7))
+        for stmt in ('reduce(lambda s, kv: s.replace(*kv), r.items(), s)',
+                     's.replace(r)'):
+            results.append((stmt, size, best_of(
+                stmt, number, s=text, r=table, reduce=reduce)))
+    return results
+
+
+def thread_scaling(threads=(1, 2, 4, 8), calls=20000):
+    """Return a list of (threads, calls per second) tuples calling patched
+    methods from that many threads at once.
+
+    The patterns are looked up in the pattern cache on every call. Under
+    the GIL the throughput stays flat, a free-threaded build should scale
+    with the number of cores.
+    """
+    import threading
+    results = []
+    for n in threads:
+        def work(seed):
+            text = 'key%d=%d; ' % (seed, seed) * 4
+            for i in range(calls):
+                text.find(gorella.compile(r'=\d'))
+                text.split(gorella.compile(r';\s*'))
+                text.find('key%d' % (i % 64))
+        workers = [threading.Thread(target=work, args=(i,))
+                   for i in range(n)]
+        started = timeit.default_timer()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = timeit.default_timer() - started
+        results.append((n, 3 * calls * n / elapsed))
+    return results
+
+
+def line_numbers(sizes=(10 ** 4, 10 ** 5), number=3):
+    """Return a list of (statement, size, seconds) tuples numbering the
+    lines of the matches by counting newlines and with `grep`.
+    """
+    results = []
+    pattern = re.compile(r'\berror\b')
+    for size in sizes:
+        text = ''.join('line %d: %s\n' % (i, 'error' if i % 50 else 'ok')
+                       for i in range(size // 16))[:size]
+        for stmt in ('[(s.count(nl, 0, m.start()) + 1, m) '
+                     'for m in p.finditer(s)]',
+                     'list(s.grep(p))'):
+            results.append((stmt, size, best_of(
+                stmt, number, s=text, p=pattern, nl='\n')))
+    return results
+
+
+def span_queries(sizes=(10 ** 5, 10 ** 7), queries=100, number=3):
+    """Return a list of (statement, size, span cache, seconds) tuples
+    querying the same string with the same pattern `queries` times.
+    """
+    results = []
+    pattern = re.compile(r'a[b]')
+    cache = gorella.span_cache
+    for size in sizes:
+        text = make_text(size, 1000)
+        starts = list(range(0, size, size // queries))
+        for stmt in ('[s.find(p, i) for i in starts]',
+                     '[s.count(p, i) for i in starts]'):
+            for maxbytes in (0, 4 * size):
+                cache.clear()
+                cache.resize(maxbytes)
+                try:
+                    seconds = best_of(stmt, number, s=text, p=pattern,
+                                      starts=starts)
+                finally:
+                    cache.resize(0)
+                results.append((stmt, size, maxbytes > 0, seconds))
+    return results
+
+
+def regressions(results, max_overhead=None, baseline=None, tolerance=1.25):
+    """Return a list of messages describing the failed thresholds."""
+    failures = []
+    describe = '%(method)s %(type)s size=%(size)d %(density)s: '
+    if max_overhead is not None:
+        for r in results:
+            ratio = r['plain'] / r['native']
+            if r['method'] not in EXTENSIONS and ratio > max_overhead:
+                failures.append(describe % r +
+                                'plain path is %.2fx native' % ratio)
+    if baseline is not None:
+        key = lambda r: (r['method'], r['type'], r['size'], r['density'])
+        old = dict((key(r), r) for r in baseline)
+        for r in results:
+            if key(r) not in old:
+                continue
+            for column in ('plain', 'pattern'):
+                ratio = r[column] / old[key(r)][column]
+                if ratio > tolerance:
+                    failures.append(describe % r + '%s path is %.2fx the '
+                                    'baseline' % (column, ratio))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the patched string methods.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--methods', nargs='+',
+                        default=gorella.methods_to_patch)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with a previous --json')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    parser.add_argument('--max-overhead', type=float, default=None)
+    parser.add_argument('--overhead', action='store_true',
+                        help='also time the plain calls of the overridden '
+                        'methods on a short string')
+    parser.add_argument('--tail', action='store_true',
+                        help='also time the searches from the end')
+    parser.add_argument('--suffix', action='store_true',
+                        help='also time endswith with patterns')
+    parser.add_argument('--lazy', action='store_true',
+                        help='also time the lazy split methods')
+    parser.add_argument('--rules', action='store_true',
+                        help='also time replace with a set of rules')
+    parser.add_argument('--lines', action='store_true',
+                        help='also time the line numbers of matches')
+    parser.add_argument('--spans', action='store_true',
+                        help='also time repeated queries with the span '
+                        'cache')
+    parser.add_argument('--threads', type=int, nargs='*',
+                        help='also time patched calls from that many '
+                        'threads at once')
+    parser.add_argument('--engines', action='store_true',
+                        help='also time the pattern path of every engine')
+    parser.add_argument('--cold-start', action='store_true',
+                        help='also time compiling 5000 patterns in a new '
+                        'process, with and without a pattern file')
+    parser.add_argument('--import-time', action='store_true',
+                        help='also time `import gorella`')
+    parser.add_argument('--max-import', type=float, default=None,
+                        help='maximum import time in milliseconds')
+    args = parser.parse_args(argv)
+
+    results = suite(args.sizes, methods=args.methods)
+    print('%-11s %-9s %9s %-5s %12s %12s %12s' % (
+        'method', 'type', 'size', 'hits', 'native us', 'plain us',
+        'pattern us'))
+    for r in results:
+        print('%-11s %-9s %9d %-5s %12.2f %12.2f %12.2f' % (
+            r['method'], r['type'], r['size'], r['density'],
+            r['native'] * 1e6, r['plain'] * 1e6, r['pattern'] * 1e6))
+    if args.overhead:
+        print()
+        print('%-11s %12s %12s %8s' % ('method', 'native ns', 'patched ns',
+                                       'ratio'))
+        for name, native, patched in overhead():
+            print('%-11s %12.1f %12.1f %8.2f' % (name, native * 1e9,
+                                                 patched * 1e9,
+                                                 patched / native))
+    if args.tail:
+        print()
+        print('%-20s %10s %12s' % ('statement', 'size', 'us'))
+        for stmt, size, seconds in tail_search():
+            print('%-20s %10d %12.1f' % (stmt, size, seconds * 1e6))
+    if args.suffix:
+        print()
+        print('%-20s %10s %12s' % ('endswith pattern', 'size', 'us'))
+        for source, size, seconds in suffix_check():
+            print('%-20s %10d %12.1f' % (source, size, seconds * 1e6))
+    if args.lazy:
+        print()
+        print('%-30s %10s %12s' % ('statement', 'size', 'us'))
+        for stmt, size, seconds in lazy_split():
+            print('%-30s %10d %12.1f' % (stmt, size, seconds * 1e6))
+    if args.rules:
+        print()
+        print('%-52s %10s %12s' % ('statement', 'size', 'us'))
+        for stmt, size, seconds in replace_rules():
+            print('%-52s %10d %12.1f' % (stmt, size, seconds * 1e6))
+    if args.lines:
+        print()
+        print('%-60s %10s %12s' % ('statement', 'size', 'us'))
+        for stmt, size, seconds in line_numbers():
+            print('%-60s %10d %12.1f' % (stmt, size, seconds * 1e6))
+    if args.spans:
+        print()
+        print('%-34s %10s %6s %12s' % ('statement', 'size', 'cache', 'us'))
+        for stmt, size, cached, seconds in span_queries():
+            print('%-34s %10d %6s %12.1f' % (stmt, size, cached,
+                                              seconds * 1e6))
+    if args.threads is not None:
+        print()
+        print('%-8s %14s %8s' % ('threads', 'calls/s', 'scaling'))
+        scaling = thread_scaling(args.threads or (1, 2, 4, 8))
+        for n, rate in scaling:
+            print('%-8d %14.0f %8.2f' % (n, rate, rate / scaling[0][1]))
+    if args.engines:
+        print()
+        print('%-11s %-11s %-5s %12s' % ('engine', 'method', 'hits',
+                                         'pattern us'))
+        for engine, name, density, seconds in backends(
+                max(args.sizes), args.methods):
+            print('%-11s %-11s %-5s %12.2f' % (engine, name, density,
+                                               seconds * 1e6))
+    if args.cold_start:
+        print()
+        print('%-12s %12s' % ('pattern file', 'ms'))
+        for loaded, seconds in cold_start():
+            print('%-12s %12.2f' % (loaded, seconds * 1e3))
+    failures = []
+    if args.import_time or args.max_import is not None:
+        print()
+        print('%-20s %12s' % ('GORELLA_PATCH', 'import ms'))
+        for value, seconds in import_time():
+            print('%-20s %12.2f' % (value, seconds * 1e3))
+            if args.max_import is not None and \
+                    seconds * 1e3 > args.max_import:
+                failures.append('import with GORELLA_PATCH=%s takes %.2fms'
+                                % (value, seconds * 1e3))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    failures += regressions(results, args.max_overhead, baseline,
+                            args.tolerance)
+    for message in failures:
+        print('REGRESSION:', message, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,42 +6,74 @@ Make regular expression easy to use.
 import re
 import os
 import sys
-import ctypes
-import inspect
+import time
+from array import array
+from bisect import bisect_left, bisect_right
 from functools import wraps
-from collections import defaultdict
+from itertools import chain, count, islice
+from operator import methodcaller
+from collections import defaultdict, deque, OrderedDict
+try:
+    from itertools import izip, imap
+except ImportError:  # Python 3
+    izip, imap = zip, map
+try:
+    from re import _parser as sre_parse, _compiler as sre_compile
+    from re import _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse, sre_compile, sre_constants
 try:
     import __builtin__
 except:
     import builtins as __builtin__
+try:
+    from _thread import RLock, get_ident
+except ImportError:  # Python 2
+    from thread import get_ident
+    from threading import RLock
 
 __version__ = '0.1.0'
 __author__ = 'Frost Ming'
 __license__ = 'MIT'
 
 IS_PY3 = sys.version_info[0] > 2
+_unichr = chr if IS_PY3 else __builtin__.unichr
+# The types of the pattern sources.
+_source_types = (str, bytes) if IS_PY3 else (str, __builtin__.unicode)
+# Type code of the arrays holding match offsets.
+SPAN_TYPECODE = 'q' if sys.version_info >= (3, 3) else 'l'
 
 # Monkey patch built in string types.
 # Refer to https://github.com/clarete/forbiddenfruit
-Py_ssize_t = \
-    hasattr(ctypes.pythonapi, 'Py_InitModule4_64') \
-    and ctypes.c_int64 or ctypes.c_int
+# ctypes and the structures below are only set up the first time a built-in
+# type is patched, importing gorella with GORELLA_PATCH=0 does not load them.
+ctypes = SlotsProxy = None
 
 
-class PyObject(ctypes.Structure):
-    pass
+def _import_ctypes():
+    global ctypes, SlotsProxy
+    if SlotsProxy is not None:
+        return
+    import ctypes
 
-PyObject._fields_ = [
-    ('ob_refcnt', Py_ssize_t),
-    ('ob_type', ctypes.POINTER(PyObject)),
-]
+    Py_ssize_t = \
+        hasattr(ctypes.pythonapi, 'Py_InitModule4_64') \
+        and ctypes.c_int64 or ctypes.c_int
 
+    class PyObject(ctypes.Structure):
+        pass
 
-class SlotsProxy(PyObject):
-    _fields_ = [('dict', ctypes.POINTER(PyObject))]
+    PyObject._fields_ = [
+        ('ob_refcnt', Py_ssize_t),
+        ('ob_type', ctypes.POINTER(PyObject)),
+    ]
+
+    class SlotsProxy(PyObject):
+        _fields_ = [('dict', ctypes.POINTER(PyObject))]
 
 
 def patchable_builtin(klass):
+    _import_ctypes()
     # It's important to create variables here, we want those objects alive
     # within this whole scope.
     name = klass.__name__
@@ -64,21 +96,39 @@ def patchable_builtin(klass):
 
 
 @wraps(__builtin__.dir)
-def __filtered_dir__(obj=None):
-    name = hasattr(obj, '__name__') and obj.__name__ or obj.__class__.__name__
-    if obj is None:
+def __filtered_dir__(*args):
+    if not args:
         # Return names from the local scope of the calling frame, taking into
         # account indirection added by __filtered_dir__
-        calling_frame = inspect.currentframe().f_back
-        return sorted(calling_frame.f_locals.keys())
-    return sorted(set(__dir__(obj)).difference(__hidden_elements__[name]))
+        return sorted(sys._getframe(1).f_locals)
+    obj = args[0]
+    name = hasattr(obj, '__name__') and obj.__name__ or obj.__class__.__name__
+    hidden = __hidden_elements__.get(name)
+    if not hidden:
+        return __dir__(*args)
+    return sorted(set(__dir__(*args)).difference(hidden))
 
-# Switching to the custom dir impl declared above
+# The custom dir impl declared above is only switched to once an attribute
+# is hidden, see `curse` and `reverse`.
 __hidden_elements__ = defaultdict(list)
-__dir__ = dir
-__builtin__.dir = __filtered_dir__
+__dir__ = __builtin__.dir
+
+# Held while the type dicts and the bookkeeping of the patched methods are
+# changed, so that concurrent patches and reverts don't interleave. The
+# patched methods themselves never take it.
+_patch_lock = RLock()
 
 
+def _synchronized(func):
+    """Run `func` holding the patch lock."""
+    @wraps(func)
+    def locked(*args, **kwargs):
+        with _patch_lock:
+            return func(*args, **kwargs)
+    return locked
+
+
+@_synchronized
 def curse(klass, attr, value, hide_from_dir=False):
     """Curse a built-in `klass` with `attr` set to `value`
     This function monkey-patches the built-in python object `attr` adding a new
@@ -102,185 +152,2584 @@ def curse(klass, attr, value, hide_from_dir=False):
     old_value = dikt.get(attr, None)
     old_name = '_c_%s' % attr   # do not use .format here, it breaks py2.{5,6}
 
-    if old_value:
-        dikt[old_name] = old_value
+    if old_name in dikt:
+        # Cursed before, keep the original value stashed.
         dikt[attr] = value
-
+    elif old_value:
+        # Name the new value first, threads see either method complete.
         try:
-            dikt[attr].__name__ = old_value.__name__
+            value.__name__ = old_value.__name__
         except (AttributeError, TypeError):  # py2.5 will raise `TypeError`
             pass
         try:
-            dikt[attr].__qualname__ = old_value.__qualname__
+            value.__qualname__ = old_value.__qualname__
         except AttributeError:
             pass
+        dikt[old_name] = old_value
+        __builtin_methods__.setdefault(klass, {})[attr] = old_value
+        dikt[attr] = value
     else:
         dikt[attr] = value
+    # The dict was written behind the interpreter's back, drop the stale
+    # entries of the method cache.
+    ctypes.pythonapi.PyType_Modified(ctypes.py_object(klass))
 
     if hide_from_dir:
         __hidden_elements__[klass.__name__].append(attr)
+        __builtin__.dir = __filtered_dir__
 
 
-def get_builtin_method(klass, name):
+@_synchronized
+def reverse(klass, attr):
+    """Undo `curse`, restoring the original value of `attr` on `klass` or
+    removing the attribute if it was added by `curse`.
+    """
     dikt = patchable_builtin(klass)
-    old_name = '_c_%s' % name
-    return dikt.get(old_name, dikt[name])
+    old_name = '_c_%s' % attr
+
+    if old_name in dikt:
+        # The original stays in `__builtin_methods__`, for the threads that
+        # already looked up the patched function or hold a bound method.
+        dikt[attr] = dikt.pop(old_name)
+    else:
+        dikt.pop(attr, None)
+    ctypes.pythonapi.PyType_Modified(ctypes.py_object(klass))
+
+    hidden = __hidden_elements__.get(klass.__name__, ())
+    if attr in hidden:
+        hidden.remove(attr)
+    if __builtin__.dir is __filtered_dir__ and \
+            not any(__hidden_elements__.values()):
+        __builtin__.dir = __dir__
+
+
+class BuiltinMethods(dict):
+    """Dispatch table of the original C methods, keyed by the patched class.
+
+    It is filled by `curse` at patch time so the patched methods can fall
+    back to the built-in implementation without any ctypes round trip.
+    Subclasses of a patched type resolve to the table of their base.
+    """
+    def __missing__(self, klass):
+        for base in getattr(klass, '__mro__', ())[1:]:
+            if base in self:
+                methods = self[klass] = self[base]
+                return methods
+        raise KeyError(klass)
+
+__builtin_methods__ = BuiltinMethods()
+
+
+def get_builtin_method(klass, name):
+    try:
+        return __builtin_methods__[klass][name]
+    except KeyError:
+        return getattr(klass, name)
+
+
+# The type of compiled regular expression objects, `re._pattern_type` is
+# gone on newer Pythons.
+_pattern_type = type(re.compile(''))
+
+
+class Engine(object):
+    """A regular expression engine the patched methods dispatch to.
+
+    `compile(pattern, flags)` returns objects of `pattern_type` providing
+    the methods of the compiled patterns of `re` used by gorella: `match`,
+    `search`, `finditer`, `findall`, `sub` and `split`, with the same
+    arguments. `parse(compiled)` returns the `sre_parse` tree of a compiled
+    pattern when the engine's syntax is the one of `re`, it is used to
+    derive the variants of `PatternOps`.
+    """
+    def __init__(self, name, compile, pattern_type, parse=None):
+        self.name = name
+        self.compile = compile
+        self.pattern_type = pattern_type
+        self._parse = parse
+
+    def __repr__(self):
+        return '<gorella.Engine %r>' % self.name
+
+    def parse(self, pattern):
+        if self._parse is None:
+            raise ValueError('%s patterns can not be parsed' % self.name)
+        return self._parse(pattern)
+
+    def anchor(self, pattern):
+        """Compile the variant of `pattern` only matching at the end."""
+        source = pattern.pattern
+        if isinstance(source, bytes):
+            source = source.decode('latin-1')
+        if pattern.flags & re.X:
+            source += '\n'  # Close a trailing comment
+        source = '(?:%s)\\Z' % source
+        if isinstance(pattern.pattern, bytes):
+            source = source.encode('latin-1')
+        return self.compile(source, pattern.flags)
+
+# Registered engines by name, and by the type of their patterns.
+engines = OrderedDict()
+__engine_types__ = {}
+# The types the patched methods take for compiled patterns.
+_pattern_types = ()
+_tuple_or_pattern = (tuple,)
+
+
+def register_engine(name, compile, pattern_type, parse=None):
+    """Make the patched methods accept the compiled patterns of another
+    engine, returned by `compile(pattern, flags)`. Return the `Engine`.
+    """
+    engine = engines[name] = Engine(name, compile, pattern_type, parse)
+    __engine_types__[pattern_type] = engine
+    _update_pattern_types()
+    return engine
+
+
+def unregister_engine(name):
+    """Stop accepting the patterns of the engine called `name`."""
+    engine = engines.pop(name)
+    del __engine_types__[engine.pattern_type]
+    _update_pattern_types()
+
+
+def _update_pattern_types():
+    global _pattern_types, _tuple_or_pattern
+    _pattern_types = tuple(__engine_types__)
+    _tuple_or_pattern = (tuple,) + _pattern_types
+
+
+def _load_regex():
+    import regex
+    return register_engine('regex', regex.compile, type(regex.compile('')))
+
+# Engines registered on first use, their modules are imported then.
+_engine_loaders = {'regex': _load_regex}
+
+
+def get_engine(name):
+    """Return the engine called `name`, registering it if it is a known
+    one whose module is not imported yet.
+    """
+    try:
+        return engines[name]
+    except KeyError:
+        if name not in _engine_loaders:
+            raise ValueError('unknown regular expression engine %r' % name)
+        return _engine_loaders[name]()
+
+
+def engine_of(pattern):
+    """Return the engine of a compiled pattern."""
+    return __engine_types__[type(pattern)]
+
+
+class LiteralMatch(object):
+    """The match object of a `Literal` pattern, it has no groups."""
+    __slots__ = ('re', 'string', 'pos', 'endpos', '_start')
+    lastindex = lastgroup = None
+
+    def __init__(self, pattern, string, start, pos, endpos):
+        self.re = pattern
+        self.string = string
+        self.pos = pos
+        self.endpos = endpos
+        self._start = start
+
+    def __repr__(self):
+        return '<gorella.LiteralMatch object; span=%r, match=%r>' % (
+            self.span(), self.group())
+
+    def _check(self, group):
+        if group not in (0, '0'):
+            raise IndexError('no such group')
+
+    def start(self, group=0):
+        self._check(group)
+        return self._start
+
+    def end(self, group=0):
+        self._check(group)
+        return self._start + len(self.re.pattern)
+
+    def span(self, group=0):
+        return self.start(group), self.end(group)
+
+    def group(self, *groups):
+        for group in groups:
+            self._check(group)
+        text = self.string[self._start:self.end()]
+        return text if len(groups) < 2 else (text,) * len(groups)
+
+    __getitem__ = group
+
+    def groups(self, default=None):
+        return ()
+
+    def groupdict(self, default=None):
+        return {}
+
+    def expand(self, template):
+        return self.re._regex.sub(template, self.group())
+
+
+class Literal(object):
+    """A pattern matching a fixed string with the built-in string methods.
+
+    It has the interface of the compiled patterns of `re`, for the strings
+    and buffers having a `find` method. Replacement templates, which may
+    only refer to the whole match, are expanded by `re`.
+    """
+    def __init__(self, pattern, flags=0):
+        if flags:
+            raise ValueError('literal patterns take no flags')
+        self.pattern = pattern
+        self.flags = 0
+        self.groups = 0
+        self.groupindex = {}
+        self._escaped = None
+
+    def __repr__(self):
+        return 'gorella.Literal(%r)' % (self.pattern,)
+
+    def __eq__(self, other):
+        return type(other) is Literal and other.pattern == self.pattern
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((Literal, self.pattern))
+
+    def __getstate__(self):
+        return self.pattern
+
+    def __setstate__(self, pattern):
+        self.__init__(pattern)
+
+    @property
+    def _regex(self):
+        # The equivalent regular expression, for what can't be done with
+        # the string methods.
+        if self._escaped is None:
+            self._escaped = re.compile(re.escape(self.pattern))
+        return self._escaped
+
+    def _bounds(self, string, pos, endpos):
+        size = len(string)
+        if endpos is None or endpos > size:
+            endpos = size
+        elif endpos < 0:
+            endpos = 0
+        if pos < 0:
+            pos = 0
+        elif pos > size:
+            pos = size
+        return pos, endpos
+
+    def _native(self, string, name):
+        # The original method rather than the patched one, when there is.
+        return getattr(string, '_c_' + name, None) or getattr(string, name)
+
+    def finditer(self, string, pos=0, endpos=None):
+        pos, endpos = self._bounds(string, pos, endpos)
+        pattern, step = self.pattern, len(self.pattern) or 1
+        find = self._native(string, 'find')
+        start = find(pattern, pos, endpos)
+        while start >= 0:
+            yield LiteralMatch(self, string, start, pos, endpos)
+            start = find(pattern, start + step, endpos)
+
+    def search(self, string, pos=0, endpos=None):
+        pos, endpos = self._bounds(string, pos, endpos)
+        find = getattr(string, '_c_find', None) or string.find
+        start = find(self.pattern, pos, endpos)
+        if start < 0:
+            return None
+        return LiteralMatch(self, string, start, pos, endpos)
+
+    def match(self, string, pos=0, endpos=None):
+        pos, endpos = self._bounds(string, pos, endpos)
+        if pos + len(self.pattern) <= endpos and \
+                string[pos:pos + len(self.pattern)] == self.pattern:
+            return LiteralMatch(self, string, pos, pos, endpos)
+        return None
+
+    def fullmatch(self, string, pos=0, endpos=None):
+        pos, endpos = self._bounds(string, pos, endpos)
+        if endpos - pos == len(self.pattern):
+            return self.match(string, pos, endpos)
+        return None
+
+    def find(self, string, pos=0, endpos=None):
+        """Return the start of the first match or -1, `re` patterns have
+        no such method.
+        """
+        pos, endpos = self._bounds(string, pos, endpos)
+        find = getattr(string, '_c_find', None) or string.find
+        return find(self.pattern, pos, endpos)
+
+    def count(self, string, pos=0, endpos=None):
+        """Count the matches, which `re` patterns can't do."""
+        if not hasattr(string, 'count'):
+            return len(self.findall(string, pos, endpos))
+        pos, endpos = self._bounds(string, pos, endpos)
+        return self._native(string, 'count')(self.pattern, pos, endpos)
+
+    def findall(self, string, pos=0, endpos=None):
+        if hasattr(string, 'count'):
+            return [self.pattern] * self.count(string, pos, endpos)
+        return [m.group() for m in self.finditer(string, pos, endpos)]
+
+    def split(self, string, maxsplit=0):
+        if not self.pattern or not hasattr(string, 'split'):
+            return self._regex.split(string, maxsplit)
+        return self._native(string, 'split')(
+            self.pattern, maxsplit if maxsplit > 0 else -1)
+
+    def sub(self, repl, string, count=0):
+        backslash = b'\\' if isinstance(repl, bytes) else '\\'
+        if callable(repl) or backslash in repl or \
+                not hasattr(string, 'replace'):
+            return self._regex.sub(repl, string, count)
+        return self._native(string, 'replace')(
+            self.pattern, repl, count if count > 0 else -1)
+
+re_engine = register_engine(
+    're', sre_compile.compile, _pattern_type,
+    lambda p: sre_parse.parse(p.pattern, p.flags))
+literal_engine = register_engine(
+    'literal', Literal, Literal,
+    lambda p: sre_parse.parse(re.escape(p.pattern)))
+
+
+class PatternCache(object):
+    """Compiled patterns, evicting the least recently used ones.
+
+    Unlike the cache of `re`, which is shared with every other library and
+    is flushed arbitrarily when full, it only holds the patterns passed to
+    gorella and keeps count of its hits, misses and evictions.
+    """
+    def __init__(self, maxsize=1024, check_backtracking=False):
+        self.maxsize = maxsize
+        self.check_backtracking = check_backtracking
+        self.hits = self.misses = self.evictions = 0
+        self._patterns = OrderedDict()
+
+    def compile(self, pattern, flags=0, engine=None):
+        """Return the compiled `pattern`, like `re.compile`.
+
+        `engine` names the engine compiling it, `re` by default.
+        """
+        if isinstance(pattern, _pattern_types):
+            if flags:
+                raise ValueError(
+                    'cannot process flags argument with a compiled pattern')
+            return pattern
+        key = type(pattern), pattern, flags, engine
+        patterns = self._patterns
+        # No lock is taken: every step below is a single operation of the
+        # ordered dict, other threads may only make it compile twice or
+        # miss an update of the counters.
+        try:
+            compiled = patterns[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            try:
+                patterns.move_to_end(key)
+            except KeyError:  # Evicted by another thread meanwhile
+                pass
+            except AttributeError:  # Python 2
+                patterns[key] = patterns.pop(key, compiled)
+            return compiled
+        if not isinstance(pattern, _source_types):
+            raise TypeError('first argument must be string or compiled '
+                            'pattern')
+        self.misses += 1
+        if engine is not None:
+            compiled = get_engine(engine).compile(pattern, flags)
+        else:
+            compiled = program_cache.records and \
+                program_cache.compile(pattern, flags)
+            if not compiled:
+                compiled = sre_compile.compile(pattern, flags)
+        if self.check_backtracking:
+            warn_backtracking(compiled)
+        if self.maxsize > 0:
+            self._evict(self.maxsize - 1)
+            patterns[key] = compiled
+        return compiled
+
+    def prewarm(self, patterns, flags=0):
+        """Compile `patterns` ahead of time, items may be (pattern, flags)
+        tuples. Return the compiled patterns.
+
+        A BacktrackingWarning is issued for the patterns prone to
+        catastrophic backtracking.
+        """
+        compiled = [self.compile(*p) if isinstance(p, tuple)
+                    else self.compile(p, flags) for p in patterns]
+        for pattern in compiled:
+            warn_backtracking(pattern)
+        return compiled
+
+    def _evict(self, size):
+        # Drop the least recently used patterns down to `size`.
+        while len(self._patterns) > size:
+            try:
+                self._patterns.popitem(last=False)
+            except KeyError:  # Emptied by another thread
+                break
+            self.evictions += 1
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        self._evict(maxsize)
+
+    def clear(self):
+        self._patterns.clear()
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._patterns),
+                'maxsize': self.maxsize}
+
+pattern_cache = PatternCache(
+    int(os.environ.get('GORELLA_CACHE_SIZE', 1024)),
+    os.environ.get('GORELLA_CHECK_BACKTRACKING', '0') != '0')
+compile = pattern_cache.compile
+prewarm = pattern_cache.prewarm
+
+
+class PatternOps(object):
+    """Variants of a compiled pattern needed by the patched methods.
+
+    They are derived from the parsed pattern rather than its source text, so
+    the groups, flags and back references of the original are kept intact.
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._anchored = None
+        self._reversed = False
+        self._widths = None
+        self._literal = False
+
+    def parse(self):
+        return engine_of(self.pattern).parse(self.pattern)
+
+    def getwidth(self):
+        if self._widths is None:
+            try:
+                self._widths = self.parse().getwidth()
+            except ValueError:  # Unknown for the other engines
+                self._widths = 0, sre_constants.MAXREPEAT
+        return self._widths
+
+    @property
+    def min_width(self):
+        """The minimum width of a match."""
+        return self.getwidth()[0]
+
+    @property
+    def width(self):
+        """The maximum width of a match, None if it is unbounded."""
+        width = self.getwidth()[1]
+        return width if width < sre_constants.MAXREPEAT else None
+
+    @property
+    def anchored(self):
+        """The pattern that only matches at the end of the string."""
+        if self._anchored is None:
+            try:
+                tree = self.parse()
+            except ValueError:
+                self._anchored = engine_of(self.pattern).anchor(self.pattern)
+            else:
+                tree.append((sre_constants.AT, sre_constants.AT_END_STRING))
+                self._anchored = sre_compile.compile(tree,
+                                                     self.pattern.flags)
+        return self._anchored
+
+    @property
+    def reversed(self):
+        """The pattern matching the reversed text of the matches, or None
+        if the pattern uses anchors, look-arounds or back references.
+        """
+        if self._reversed is False:
+            try:
+                tree = reverse_tree(self.parse())
+            except ValueError:
+                self._reversed = None
+            else:
+                self._reversed = sre_compile.compile(tree, self.pattern.flags)
+        return self._reversed
+
+    @property
+    def literal(self):
+        """The `Literal` the pattern is equivalent to, or None.
+
+        Only non empty patterns of `re` without IGNORECASE can be
+        literals.
+        """
+        if self._literal is False:
+            self._literal = None
+            if type(self.pattern) is _pattern_type and \
+                    not self.pattern.flags & re.I and \
+                    not self.pattern.groups:
+                codes = []
+                for op, av in self.parse():
+                    if op != sre_constants.LITERAL:
+                        break
+                    codes.append(av)
+                else:
+                    # The native methods reject empty separators.
+                    if codes:
+                        self._literal = Literal(self._text(codes))
+        return self._literal
+
+    def _text(self, codes):
+        if isinstance(self.pattern.pattern, bytes):
+            return bytes(bytearray(codes))
+        return self.pattern.pattern[:0].join(imap(_unichr, codes))
+
+    def endswith(self, string, start, end):
+        """Tell if the pattern matches `string[start:end]` up to `end`.
+
+        Only the tail of the string is examined: a window as wide as the
+        longest match for patterns of bounded width, else the reversed tail
+        matched by the reversed pattern, in windows growing until a match
+        is found or the whole range was examined.
+        """
+        # Clamp the range like the regular expression engine does.
+        end = min(max(end, 0), len(string))
+        start = max(start, 0)
+        if end - start < self.min_width:
+            return False
+        width = self.width
+        if width is not None:
+            pos = max(start, end - width)
+            return self.anchored.search(string, pos, end) is not None
+        rev = self.reversed
+        if rev is None:
+            return self.anchored.search(string, start, end) is not None
+        size = 256
+        while True:
+            pos = max(start, end - size)
+            if rev.match(string[pos:end][::-1]) is not None:
+                return True
+            if pos == start:
+                return False
+            size *= 4
+
+
+# Opcodes kept as they are, and holding sub-patterns, in a reversed pattern.
+_REVERSIBLE_LEAVES = (sre_constants.LITERAL, sre_constants.NOT_LITERAL,
+                      sre_constants.ANY, sre_constants.IN)
+_REVERSIBLE_NODES = (sre_constants.SUBPATTERN, sre_constants.BRANCH,
+                     sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+
+def reverse_tree(tree):
+    """Return the parsed pattern matching the reversed strings matched by
+    `tree`, raise ValueError if it has no such counterpart.
+    """
+    data = []
+    for op, av in tree:
+        if op in _REVERSIBLE_NODES:
+            av = tuple(_reverse_item(item) for item in av)
+        elif op not in _REVERSIBLE_LEAVES:
+            raise ValueError('%s can not be reversed' % op)
+        data.append((op, av))
+    data.reverse()
+    return sre_parse.SubPattern(tree.state, data)
+
+
+def _reverse_item(item):
+    if isinstance(item, sre_parse.SubPattern):
+        return reverse_tree(item)
+    if isinstance(item, list):
+        return [_reverse_item(sub) for sub in item]
+    return item
+
+# Derived variants are dropped together with the pattern they come from.
+# The weak dict is created on first use, keeping weakref off the import path.
+__pattern_ops__ = None
+
+
+def get_pattern_ops(pattern):
+    global __pattern_ops__
+    if __pattern_ops__ is None:
+        import weakref
+        __pattern_ops__ = weakref.WeakKeyDictionary()
+    try:
+        return __pattern_ops__[pattern]
+    except KeyError:
+        pass
+    ops = PatternOps(pattern)
+    if program_cache.records and type(pattern) is _pattern_type:
+        program_cache.seed(ops)
+    # Threads racing here agree on the first one stored.
+    return __pattern_ops__.setdefault(pattern, ops)
+
+
+def _program(tree, flags, pattern=None):
+    # The arguments of `_sre.compile` for the parsed `tree`, as
+    # `sre_compile.compile` computes them. The opcodes and flags are int
+    # subclasses, turned into plain ints for marshal.
+    state = getattr(tree, 'state', None) or tree.pattern
+    indexgroup = [None] * state.groups
+    for name, i in state.groupdict.items():
+        indexgroup[i] = name
+    return (pattern, int(flags | state.flags),
+            list(imap(int, sre_compile._code(tree, flags))),
+            state.groups - 1, dict(state.groupdict), tuple(indexgroup))
+
+# The first bytes of the files of `ProgramCache`, and the version of their
+# layout.
+PROGRAMS_MAGIC = b'GORELLA\x00'
+PROGRAMS_FORMAT = 1
+
+
+class ProgramCache(object):
+    """Compiled programs of patterns of `re` saved to a file, from which
+    other processes rebuild the patterns without parsing them again.
+
+    Along with its program, the record of a pattern holds the variants
+    `PatternOps` had derived from it when it was saved. The file is memory
+    mapped and the records are only read when their pattern is compiled. A
+    file written by another interpreter version is ignored.
+    """
+    def __init__(self):
+        self.path = None
+        self.records = {}
+        self._map = None
+        self._base = 0
+
+    @staticmethod
+    def _header():
+        import _sre
+        return (PROGRAMS_FORMAT, sys.version, sre_constants.MAGIC,
+                _sre.CODESIZE, sys.maxunicode)
+
+    def load(self, path):
+        """Map the file at `path`, return the number of patterns it holds,
+        0 if it is missing or was not written by this interpreter.
+        """
+        import mmap
+        import marshal
+        import struct
+        self.close()
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):  # Missing or empty
+            return 0
+        try:
+            offset = len(PROGRAMS_MAGIC) + 8
+            header_size, index_size = struct.unpack(
+                '<II', data[len(PROGRAMS_MAGIC):offset])
+            if data[:len(PROGRAMS_MAGIC)] != PROGRAMS_MAGIC or \
+                    marshal.loads(data[offset:offset + header_size]) != \
+                    self._header():
+                raise ValueError('stale file')
+            offset += header_size
+            records = marshal.loads(data[offset:offset + index_size])
+        except (ValueError, EOFError, TypeError, struct.error):
+            data.close()
+            return 0
+        self.path, self.records, self._map = path, records, data
+        self._base = offset + index_size
+        return len(set(records.values()))
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self.path, self.records, self._map = None, {}, None
+
+    def _raw(self, key):
+        offset, size = self.records[key]
+        return self._map[self._base + offset:self._base + offset + size]
+
+    def get(self, pattern, flags=0):
+        """Return the record of `pattern` compiled with `flags`, or None."""
+        import marshal
+        try:
+            return marshal.loads(self._raw((pattern, flags)))
+        except (KeyError, TypeError, ValueError, EOFError):
+            return None
+
+    def compile(self, pattern, flags=0):
+        """Rebuild the compiled `pattern`, return None if it is not in the
+        file. Its variants are set by `seed` once they are needed.
+        """
+        import _sre
+        record = self.get(pattern, flags)
+        return record and _sre.compile(*record['program'])
+
+    def seed(self, ops, record=None):
+        """Set the variants of `ops` found in the record of its pattern."""
+        import _sre
+        if record is None:
+            record = self.get(ops.pattern.pattern, ops.pattern.flags)
+            if record is None:
+                return
+        if ops._widths is None:
+            ops._widths = tuple(record['widths'])
+        if ops._literal is False:
+            text = record['literal']
+            ops._literal = None if text is None else Literal(text)
+        if ops._anchored is None and 'anchored' in record:
+            ops._anchored = _sre.compile(*record['anchored'])
+        if ops._reversed is False and 'reversed' in record:
+            program = record['reversed']
+            ops._reversed = program and _sre.compile(*program)
+
+    @staticmethod
+    def record(pattern, flags=0):
+        """Return the record of the compiled `pattern`, compiled with
+        `flags`.
+        """
+        tree = sre_parse.parse(pattern.pattern, flags)
+        ops = get_pattern_ops(pattern)
+        literal = ops.literal
+        record = {'program': _program(tree, flags, pattern.pattern),
+                  'widths': tuple(imap(int, ops.getwidth())),
+                  'literal': literal and literal.pattern}
+        if ops._anchored is not None:
+            tree = ops.parse()
+            tree.append((sre_constants.AT, sre_constants.AT_END_STRING))
+            record['anchored'] = _program(tree, pattern.flags)
+        if ops._reversed is not False:
+            record['reversed'] = ops._reversed and _program(
+                reverse_tree(ops.parse()), pattern.flags)
+        return record
+
+    def save(self, path, patterns=None):
+        """Write the records of `patterns` to `path`, along with the ones of
+        the file loaded if it is the same, and load it. Return the number of
+        patterns written.
+
+        `patterns` are sources, (source, flags) tuples or compiled patterns
+        and default to the patterns of `re` in the pattern cache.
+        """
+        import marshal
+        import struct
+        if patterns is None:
+            patterns = [(key[1], key[2])
+                        for key in list(pattern_cache._patterns)
+                        if key[3] is None]
+        raw = {}
+        if self._map is not None and self.path == path:
+            for key in self.records:
+                raw[key] = self._raw(key)
+        for p in patterns:
+            source, flags = (p.pattern, p.flags) \
+                if isinstance(p, _pattern_type) \
+                else p if isinstance(p, tuple) else (p, 0)
+            flags = int(flags)
+            compiled = p if isinstance(p, _pattern_type) \
+                else compile(source, flags)
+            data = marshal.dumps(self.record(compiled, flags))
+            raw[source, flags] = raw[source, compiled.flags] = data
+        # Keys sharing a record share its bytes.
+        blobs, index, offset = {}, {}, 0
+        for key, data in raw.items():
+            if data not in blobs:
+                blobs[data] = offset, len(data)
+                offset += len(data)
+            index[key] = blobs[data]
+        header = marshal.dumps(self._header())
+        index_data = marshal.dumps(index)
+        self.close()
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(PROGRAMS_MAGIC)
+            f.write(struct.pack('<II', len(header), len(index_data)))
+            f.write(header)
+            f.write(index_data)
+            for data, _ in sorted(blobs.items(), key=lambda b: b[1]):
+                f.write(data)
+        getattr(os, 'replace', os.rename)(tmp, path)
+        return self.load(path)
+
+program_cache = ProgramCache()
+
+
+def load_pattern_cache(path):
+    """Load the compiled patterns saved to `path`, see `ProgramCache`."""
+    return program_cache.load(path)
+
+
+def save_pattern_cache(path, patterns=None):
+    """Save compiled patterns to `path`, see `ProgramCache.save`."""
+    return program_cache.save(path, patterns)
+
+
+# The literals of the patterns passed to the patched methods, a plain dict
+# is cheaper to look up than the weak one of `PatternOps`.
+__pattern_literals__ = {}
+
+# Shorter strings go straight to `re`, looking up the literal of the pattern
+# would cost more than the native methods save.
+NATIVE_MIN_LENGTH = 256
+
+
+def literal_route(pattern, string):
+    """Return the `Literal` equivalent to `pattern` when the native methods
+    of `string` give the same results as `re`, else None.
+
+    Callers only route the strings of at least NATIVE_MIN_LENGTH.
+    """
+    if type(string) not in _literal_types:
+        return None
+    try:
+        return __pattern_literals__[pattern]
+    except KeyError:
+        pass
+    if len(__pattern_literals__) >= 1024:
+        __pattern_literals__.clear()
+    literal = __pattern_literals__[pattern] = get_pattern_ops(pattern).literal
+    return literal
+
+
+def last_matches(pattern, string, count, start=0, end=None):
+    """Return the last `count` matches of `pattern` in order.
+
+    The matches are the ones a forward scan from `start` would find. For
+    patterns of bounded width the scan starts from a window at the end of
+    the string, growing backwards until it holds enough matches, so the cost
+    depends on the distance from the end rather than the string length.
+    """
+    if end is None: end = len(string)
+    if end - start > 256:
+        width = get_pattern_ops(pattern).width
+        size = max(width or 0, 64) * 4
+        while width is not None and end - size > start:
+            pos = _sync_position(pattern, string, end - size, start, end,
+                                 width)
+            if pos is not None:
+                matches = deque(pattern.finditer(string, pos, end), count)
+                if len(matches) == count:
+                    return list(matches)
+            size *= 4
+    return list(deque(pattern.finditer(string, start, end), count))
+
+
+def iter_last_matches(pattern, string, start=0, end=None):
+    """Yield the matches a forward scan from `start` would find, from the
+    last one to the first.
+
+    For patterns of bounded width the string is scanned in windows from the
+    end, only the matches of the current window are held. The matches of
+    other patterns are all collected first.
+    """
+    if end is None: end = len(string)
+    # The matches starting before `hi` are left to yield.
+    hi = end + 1
+    width = get_pattern_ops(pattern).width
+    size = max(width or 0, 64) * 4
+    while width is not None and hi - size > start:
+        pos = _sync_position(pattern, string, hi - size, start, end, width)
+        if pos is None:
+            size *= 4
+            continue
+        window = []
+        for m in pattern.finditer(string, pos, end):
+            if m.start() >= hi:
+                break
+            window.append(m)
+        for m in reversed(window):
+            yield m
+        hi = pos
+    window = []
+    for m in pattern.finditer(string, start, end):
+        if m.start() >= hi:
+            break
+        window.append(m)
+    for m in reversed(window):
+        yield m
+
+
+def _sync_position(pattern, string, pos, start, end, width, attempts=8):
+    """Find a position at or before `pos` that no match can straddle.
+
+    A forward scan started there finds the same matches as one started from
+    `start`. Return None if there is no such position close to `pos`.
+    """
+    for _ in range(attempts):
+        if pos - width < start:
+            return None
+        m = pattern.search(string, pos - width + 1, end)
+        if m is None or m.start() >= pos:
+            return pos
+        pos = m.start()
+    return None
+
+
+def iter_opcodes(tree):
+    """Yield the opcodes of a parsed pattern, nested ones included."""
+    for op, av in tree:
+        yield op
+        for item in av if isinstance(av, (tuple, list)) else ():
+            if isinstance(item, sre_parse.SubPattern):
+                item = [item]
+            if isinstance(item, (tuple, list)):
+                for sub in item:
+                    if isinstance(sub, sre_parse.SubPattern):
+                        for op in iter_opcodes(sub):
+                            yield op
+
+
+# Flags that can be scoped to a part of a pattern and the inline letters.
+_SCOPED_FLAGS = ((re.I, 'i'), (re.M, 'm'), (re.S, 's'), (re.X, 'x'))
+_SCOPED_MASK = re.I | re.M | re.S | re.X
+_LEADING_FLAGS = re.compile(r'^(?:\(\?[aiLmsux]+\))+')
+_GROUPREFS = (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS)
+
+
+class PatternSet(object):
+    """Several compiled patterns matched together in a single pass.
+
+    They are joined into one alternation with a named group for each
+    pattern, which tells which of them matched. Patterns that can't be
+    joined, because of back references, different global flags or types,
+    are tried one after another instead.
+    """
+    def __init__(self, patterns, literals=()):
+        self.patterns = patterns
+        self.literals = literals
+        self.combined = None
+        self._which = {}
+        if len(patterns) > 1:
+            try:
+                self.combined = self._combine()
+            except (re.error, ValueError):
+                pass
+        if self.combined is not None:
+            for i in range(len(patterns)):
+                self._which[self.combined.groupindex['_gorella_%d' % i]] = i
+
+    def _combine(self):
+        global_flags = set()
+        kinds = set()
+        parts = []
+        for i, p in enumerate(self.patterns):
+            # Escaped literals match the same text under any global flag,
+            # like the re.U every pattern of str has.
+            if not isinstance(p, Literal):
+                global_flags.add(p.flags & ~_SCOPED_MASK)
+            kinds.add(type(p.pattern))
+            if any(op in _GROUPREFS for op in iter_opcodes(
+                    get_pattern_ops(p).parse())):
+                raise ValueError('back references would be renumbered')
+            source = p.pattern
+            if isinstance(p, Literal):
+                source = re.escape(source)
+            elif type(p) is not _pattern_type:
+                raise ValueError('only patterns of re can be combined')
+            if isinstance(source, bytes):
+                source = source.decode('latin-1')
+            source = _LEADING_FLAGS.sub('', source)
+            on = ''.join(l for flag, l in _SCOPED_FLAGS if p.flags & flag)
+            off = ''.join(l for flag, l in _SCOPED_FLAGS
+                          if not p.flags & flag)
+            if p.flags & re.X:
+                source += '\n'  # Close a trailing comment
+            # `re` rejects an empty list of flags after the dash.
+            parts.append('(?P<_gorella_%d>(?%s%s:%s))'
+                         % (i, on, off and '-' + off, source))
+        if len(global_flags) > 1 or len(kinds) > 1:
+            raise ValueError('patterns can not be combined')
+        source = '|'.join(parts)
+        if kinds.pop() is bytes:
+            source = source.encode('latin-1')
+        return re.compile(source, global_flags.pop() if global_flags else 0)
+
+    def match(self, string, pos, endpos):
+        """Return the index of the first pattern matching at `pos`, or -1."""
+        if self.combined is not None:
+            m = self.combined.match(string, pos, endpos)
+            return -1 if m is None else self._which[m.lastindex]
+        for i, p in enumerate(self.patterns):
+            if p.match(string, pos, endpos) is not None:
+                return i
+        return -1
+
+    def search(self, string, pos, endpos):
+        """Return the leftmost match of any pattern and the index of that
+        pattern, or None. The first pattern wins between matches starting
+        at the same position.
+        """
+        if self.combined is not None:
+            m = self.combined.search(string, pos, endpos)
+            if m is None:
+                return None
+            i = self._which[m.lastindex]
+            # The original pattern matches the same text at that position.
+            return i, self.patterns[i].match(string, m.start(), endpos)
+        found = None
+        for i, p in enumerate(self.patterns):
+            m = p.search(string, pos, endpos)
+            if m is not None and (found is None
+                                  or m.start() < found[1].start()):
+                found = i, m
+        return found
+
+    def endswith(self, string, pos, endpos):
+        """Tell if any of the patterns matches up to `endpos`."""
+        if self.combined is not None:
+            patterns = [self.combined]
+        else:
+            patterns = self.patterns
+        for p in patterns:
+            if get_pattern_ops(p).endswith(string, pos, endpos):
+                return True
+        return False
+
+# Pattern sets of the tuples passed to the patched methods.
+__pattern_sets__ = {}
+
+
+def get_pattern_set(items, literal=False):
+    """Return the cached `PatternSet` of a tuple of patterns.
+
+    Plain strings are regular expressions, or kept apart as `literals` if
+    `literal` is true.
+    """
+    key = items, literal
+    try:
+        return __pattern_sets__[key]
+    except KeyError:
+        pass
+    patterns = tuple(
+        compile(p)
+        for p in items if not literal or isinstance(p, _pattern_types))
+    literals = tuple(p for p in items if not isinstance(p, _pattern_types)) \
+        if literal else ()
+    if len(__pattern_sets__) >= 256:
+        __pattern_sets__.clear()
+    ps = __pattern_sets__[key] = PatternSet(patterns, literals)
+    return ps
+
+
+class ReplaceRules(object):
+    """Several (pattern, replacement) rules applied in a single pass.
+
+    Plain strings are literals. The patterns are joined by a `PatternSet`,
+    the leftmost match of any rule is replaced, the first rule winning
+    between matches at the same position, and the replaced text is not
+    looked at again. Replacements are templates or functions of the match
+    of their own rule, like for `re.sub`.
+    """
+    def __init__(self, rules):
+        for rule in rules:
+            if not isinstance(rule, (tuple, list)) or len(rule) != 2:
+                raise TypeError('replace() rules must be (pattern, '
+                                'replacement) pairs, not %r' % (rule,))
+        self.patterns = PatternSet(tuple(
+            p if isinstance(p, _pattern_types) else compile(p, engine='literal')
+            for p, _ in rules))
+        self.replacements = tuple(r for _, r in rules)
+        # The replacements used as they are, by the group of the combined
+        # pattern they belong to.
+        self._plain = {}
+        for index, i in self.patterns._which.items():
+            new = self.replacements[i]
+            if not callable(new) and \
+                    (b'\\' if isinstance(new, bytes) else '\\') not in new:
+                self._plain[index] = new
+        # Rules that are all literals with plain replacements are joined
+        # without groups, which lets `re` factor their common prefixes, and
+        # the replacements are looked up by the matched text.
+        self._literals = None
+        self._table = {}
+        literals = self.patterns.patterns
+        if self.patterns.combined is not None and \
+                all(isinstance(p, Literal) for p in literals) and \
+                len(self._plain) == len(self.replacements):
+            for p, new in zip(literals, self.replacements):
+                self._table.setdefault(p.pattern, new)
+            sep = b'|' if isinstance(literals[0].pattern, bytes) else '|'
+            self._literals = re.compile(
+                sep.join(re.escape(p.pattern) for p in literals))
+
+    def _expand(self, i, m):
+        new = self.replacements[i]
+        return new(m) if callable(new) else m.expand(new)
+
+    def _literal_replacement(self, m):
+        return self._table[m.group()]
+
+    def _combined_replacement(self, m):
+        try:
+            return self._plain[m.lastindex]
+        except KeyError:
+            i = self.patterns._which[m.lastindex]
+            # The rule's own pattern matches the same text at that position.
+            return self._expand(i, self.patterns.patterns[i].match(
+                m.string, m.start()))
+
+    def sub(self, string, count=0):
+        """Return `string` with the matches of the rules replaced, at most
+        `count` of them if it is positive.
+        """
+        if self._literals is not None:
+            return self._literals.sub(self._literal_replacement, string, count)
+        combined = self.patterns.combined
+        if combined is not None:
+            return combined.sub(self._combined_replacement, string, count)
+        if len(self.replacements) == 1:
+            return self.patterns.patterns[0].sub(self.replacements[0], string,
+                                                 count)
+        pieces, pos, end, n = [], 0, len(string), 0
+        advance = False
+        while count <= 0 or n < count:
+            if advance:
+                found = self._search_advancing(string, pos, end)
+            else:
+                found = self.patterns.search(string, pos, end)
+            if found is None:
+                break
+            i, m = found
+            pieces.append(string[pos:m.start()])
+            pieces.append(self._expand(i, m))
+            n += 1
+            pos = m.end()
+            # Like `re.sub`, an empty match may be followed by a non empty
+            # one at the same position.
+            advance = m.start() == pos
+        pieces.append(string[pos:])
+        return string[0:0].join(pieces)
+
+    def _search_advancing(self, string, pos, end):
+        # The leftmost match that isn't empty at `pos`, the first rule
+        # winning ties. The second match `finditer` yields after an empty
+        # one is the one `re` finds when it must advance.
+        found = None
+        for i, p in enumerate(self.patterns.patterns):
+            for m in p.finditer(string, pos, end):
+                if m.end() > pos:
+                    if found is None or m.start() < found[1].start():
+                        found = i, m
+                    break
+        return found
+
+
+# Rule sets passed to `replace`, keyed by their items.
+__replace_rules__ = {}
+# The types of the rule sets `replace` takes.
+_RULES = (dict, list, tuple)
+
+
+def get_replace_rules(rules):
+    """Return the cached `ReplaceRules` of a mapping or a sequence of
+    (pattern, replacement) pairs.
+    """
+    items = tuple(rules.items() if isinstance(rules, dict) else rules)
+    try:
+        return __replace_rules__[items]
+    except KeyError:
+        pass
+    except TypeError:  # Unhashable replacements
+        return ReplaceRules(items)
+    if len(__replace_rules__) >= 256:
+        __replace_rules__.clear()
+    rs = __replace_rules__[items] = ReplaceRules(items)
+    return rs
+
+
+def count_matches(pattern, string, start=0, end=None):
+    """Count the matches of `pattern` without keeping any of them."""
+    if len(string) >= NATIVE_MIN_LENGTH and \
+            not isinstance(pattern, Literal):
+        pattern = literal_route(pattern, string) or pattern
+    if isinstance(pattern, Literal):
+        return pattern.count(string, start, end)
+    if end is None: end = len(string)
+    counter = count()
+    deque(izip(pattern.finditer(string, start, end), counter), 0)
+    return next(counter)
+
+
+def _like(string, pieces):
+    # `re` returns bytes for a bytearray, the methods of bytearray return
+    # bytearrays.
+    if not isinstance(string, bytearray):
+        return pieces
+    return [None if p is None else bytearray(p) for p in pieces]
+
+
+def split_matches(string, matches, start=0):
+    """Split `string[start:]` around `matches` like `re.split` does."""
+    rs, pos = [], start
+    for m in matches:
+        rs.append(string[pos:m.start()])
+        rs.extend(_like(string, m.groups()))
+        pos = m.end()
+    rs.append(string[pos:])
+    return rs
+
+
+class Spans(object):
+    """The spans of all the matches of a pattern found by a full scan of a
+    string, answering the position queries by binary search.
+
+    The queries return None when the scan from `start` could find other
+    matches than the full scan, because `start` falls within one of them.
+    The callers then search again.
+    """
+    __slots__ = ('string', 'starts', 'ends')
+
+    def __init__(self, pattern, string):
+        self.string = string
+        self.starts = array(SPAN_TYPECODE)
+        self.ends = array(SPAN_TYPECODE)
+        for m in pattern.finditer(string):
+            self.starts.append(m.start())
+            self.ends.append(m.end())
+
+    def nbytes(self):
+        return self.starts.itemsize * len(self.starts) * 2
+
+    def first_after(self, start):
+        # The index of the first match of a scan from `start`, or None.
+        if start < 0:
+            start = 0
+        elif start > len(self.string):
+            return None
+        i = bisect_left(self.starts, start)
+        if i and self.ends[i - 1] > start:
+            return None
+        return i
+
+    def find(self, start=0):
+        i = self.first_after(start)
+        if i is None:
+            return None
+        return self.starts[i] if i < len(self.starts) else -1
+
+    def rfind(self, start=0):
+        i = self.first_after(start)
+        if i is None:
+            return None
+        return self.starts[-1] if i < len(self.starts) else -1
+
+    def count(self, start=0):
+        i = self.first_after(start)
+        return None if i is None else len(self.starts) - i
+
+
+class SpanCache(object):
+    """Match spans of patterns in large strings, for the patched methods
+    queried again and again with the same pattern on the same string.
+
+    Entries are keyed by the identity of the string and the pattern, and
+    keep the string alive. Strings shorter than `min_length`, bytearrays,
+    which may change, and queries with an `end` before the end of the
+    string are left to the usual search. The cache is disabled while
+    `maxbytes` is 0, else the least recently used entries are evicted to
+    keep the size of the spans and of the strings held under `maxbytes`.
+    """
+    def __init__(self, maxbytes=0, min_length=4096):
+        self.maxbytes = maxbytes
+        self.min_length = min_length
+        self.hits = self.misses = self.evictions = 0
+        self.nbytes = 0
+        self._spans = OrderedDict()
+        # The lengths of the strings whose spans didn't fit, by key, so
+        # they are not scanned again for nothing. A reused identity can only
+        # make a string skip the cache.
+        self._too_big = {}
+
+    def get(self, pattern, string):
+        """Return the `Spans` of `pattern` in `string`, or None if the
+        string is not cached.
+        """
+        if type(string) not in _literal_types or \
+                len(string) < self.min_length:
+            return None
+        if sys.getsizeof(string) > self.maxbytes:
+            return None
+        key = id(string), pattern
+        spans = self._spans.get(key)
+        if spans is not None and spans.string is string:
+            self.hits += 1
+            try:
+                self._spans.move_to_end(key)
+            except KeyError:  # Evicted by another thread meanwhile
+                pass
+            except AttributeError:  # Python 2
+                self._spans[key] = self._spans.pop(key, spans)
+            return spans
+        if self._too_big.get(key) == len(string):
+            return None
+        self.misses += 1
+        spans = Spans(pattern, string)
+        size = spans.nbytes() + sys.getsizeof(string)
+        if size > self.maxbytes:
+            # The callers search again, the next queries skip the scan.
+            if len(self._too_big) >= 1024:
+                self._too_big.clear()
+            self._too_big[key] = len(string)
+            return None
+        self._evict(self.maxbytes - size)
+        old = self._spans.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes() + sys.getsizeof(old.string)
+        self._spans[key] = spans
+        self.nbytes += size
+        return spans
+
+    def _evict(self, nbytes):
+        # Drop the least recently used entries down to `nbytes`.
+        while self.nbytes > nbytes:
+            try:
+                _, spans = self._spans.popitem(last=False)
+            except KeyError:  # Emptied by another thread
+                break
+            self.nbytes -= spans.nbytes() + sys.getsizeof(spans.string)
+            self.evictions += 1
+
+    def resize(self, maxbytes):
+        self.maxbytes = maxbytes
+        self._too_big.clear()
+        self._evict(maxbytes)
+
+    def clear(self):
+        self._spans.clear()
+        self._too_big.clear()
+        self.nbytes = 0
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._spans),
+                'nbytes': self.nbytes, 'maxbytes': self.maxbytes,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.0}
+
+span_cache = SpanCache(int(os.environ.get('GORELLA_SPAN_CACHE', 0)))
+
+
+def cached_spans(pattern, string, end=None):
+    """Return the cached `Spans` of `pattern` in `string` for a query up
+    to `end`, or None if the span cache doesn't apply.
+    """
+    if not span_cache.maxbytes or \
+            end is not None and end < len(string):
+        return None
+    return span_cache.get(pattern, string)
+
+
+# Matches of the fields separated by whitespace, as `split()` finds them.
+_FIELDS = {str: re.compile(r'\S+', re.U), bytes: re.compile(br'\S+')}
+
+
+def _fields(string):
+    if isinstance(string, (bytes, bytearray)):
+        return _FIELDS[bytes]
+    return _FIELDS[str] if isinstance(string, str) else \
+        re.compile(u'\\S+', re.U)
+
+
+def _isplit(string, sep, maxsplit):
+    if isinstance(sep, _pattern_types):
+        pos = 0
+        for m in islice(sep.finditer(string), maxsplit if maxsplit >= 0
+                        else None):
+            yield string[pos:m.start()]
+            for group in _like(string, m.groups()):
+                yield group
+            pos = m.end()
+        yield string[pos:]
+    elif sep is None:
+        fields = _fields(string).finditer(string)
+        for m in islice(fields, maxsplit if maxsplit >= 0 else None):
+            yield m.group()
+        for m in fields:
+            yield string[m.start():]
+            break
+    else:
+        find = get_builtin_method(string.__class__, 'find')
+        pos, i = 0, find(string, sep)
+        while i >= 0 and maxsplit != 0:
+            yield string[pos:i]
+            pos = i + len(sep)
+            i = find(string, sep, pos)
+            maxsplit -= 1
+        yield string[pos:]
+
+
+def _irsplit(string, sep, maxsplit):
+    if isinstance(sep, _pattern_types):
+        end = len(string)
+        for m in islice(iter_last_matches(sep, string),
+                        maxsplit if maxsplit >= 0 else None):
+            yield string[m.end():end]
+            for group in reversed(_like(string, m.groups())):
+                yield group
+            end = m.start()
+        yield string[:end]
+    elif sep is None:
+        # Scan windows from the end, the first field found in a window may
+        # go on before it and is looked for again in the next one.
+        fields, hi, size = _fields(string), len(string), 256
+        while hi > 0:
+            lo = max(hi - size, 0)
+            found = list(fields.finditer(string, lo, hi))
+            if lo > 0 and found and found[0].start() == lo and \
+                    not string[lo - 1:lo].isspace():
+                partial = found.pop(0)
+            else:
+                partial = None
+            for m in reversed(found):
+                if maxsplit == 0:
+                    head = string[:m.end()].rstrip()
+                    if head:
+                        yield head
+                    return
+                yield m.group()
+                maxsplit -= 1
+            if partial is None:
+                hi = lo
+            elif found:
+                hi = partial.end()
+            else:
+                size *= 2  # The field is longer than the window
+    else:
+        rfind = get_builtin_method(string.__class__, 'rfind')
+        end, i = len(string), rfind(string, sep)
+        while i >= 0 and maxsplit != 0:
+            yield string[i + len(sep):end]
+            end = i
+            i = rfind(string, sep, 0, end)
+            maxsplit -= 1
+        yield string[:end]
+
+
+def _check_separator(string, sep):
+    # Raise the errors of `split` when called rather than when iterated.
+    if sep is not None and not isinstance(sep, _pattern_types):
+        get_builtin_method(string.__class__, 'split')(string[:0], sep)
+
+
+class LineIndex(object):
+    """The offsets of the line starts of a text, built once to map the
+    offsets of many matches to line and column numbers.
+
+    Lines are separated by newlines only and numbered from 1, columns are
+    offsets within the line from 0, like the positions of `ast` nodes. The
+    index of a bytearray is only valid until the bytearray changes.
+    """
+    def __init__(self, string):
+        self.string = string
+        newline = b'\n' if isinstance(string, (bytes, bytearray)) else '\n'
+        self.starts = starts = array(SPAN_TYPECODE, [0])
+        # The newlines are found by the native method, no line is copied.
+        append = starts.append
+        find = getattr(string, '_c_find', None) or string.find
+        pos = find(newline)
+        while pos >= 0:
+            pos += 1
+            append(pos)
+            pos = find(newline, pos)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def line_of(self, offset):
+        """Return the number of the line holding `offset`."""
+        return bisect_right(self.starts, offset)
+
+    def position(self, offset):
+        """Return the (line, column) of `offset`."""
+        line = bisect_right(self.starts, offset)
+        return line, offset - self.starts[line - 1]
+
+    def line(self, number):
+        """Return the text of the line `number`, without its newline."""
+        if not 0 < number <= len(self.starts):
+            raise IndexError('line number out of range')
+        start = self.starts[number - 1]
+        if number == len(self.starts):
+            return self.string[start:]
+        return self.string[start:self.starts[number] - 1]
+
+
+def _grep(string, pattern, index):
+    for m in pattern.finditer(string):
+        if index is None:
+            index = LineIndex(string)
+        line, column = index.position(m.start())
+        yield line, column, m
 
 
 class PatchClass(object):
-    match = lambda self, pat, flags=0: re.match(pat, self, flags)
+    match = lambda self, pat, flags=0: compile(pat, flags).match(self)
     match = staticmethod(match)
-    search = lambda self, pat, flags=0: re.search(pat, self, flags)
+    search = lambda self, pat, flags=0: compile(pat, flags).search(self)
     search = staticmethod(search)
-    findall = lambda self, pat, flags=0: re.findall(pat, self, flags)
+    findall = lambda self, pat, flags=0: compile(pat, flags).findall(self)
     findall = staticmethod(findall)
-    finditer = lambda self, pat, flags=0: re.finditer(pat, self, flags)
+    finditer = lambda self, pat, flags=0: compile(pat, flags).finditer(self)
     finditer = staticmethod(finditer)
 
     @staticmethod
-    def replace(self, pat, new, count=None):
-        if isinstance(pat, re._pattern_type):
-            return pat.sub(new, self, count or 0)
-        return get_builtin_method(self.__class__, 'replace')(
-            self, pat, new, count or -1)
+    def find_spans(self, pat, start=0, end=None):
+        """Return the offsets of all matches as a flat array of
+        (start, end) pairs.
+        """
+        pat = compile(pat)
+        if end is None: end = len(self)
+        spans = array(SPAN_TYPECODE)
+        spans.extend(chain.from_iterable(
+            imap(methodcaller('span'), pat.finditer(self, start, end))))
+        return spans
+
+    @staticmethod
+    def search_any(self, patterns, pos=0, endpos=None):
+        """Search for several patterns in a single pass.
+
+        Return the index of the pattern with the leftmost match and that
+        match, or None.
+        """
+        if endpos is None: endpos = len(self)
+        return get_pattern_set(tuple(patterns)).search(self, pos, endpos)
+
+    @staticmethod
+    def find_any(self, patterns, start=0, end=None):
+        """Return the index of the pattern with the leftmost match and the
+        position of that match, or (-1, -1).
+        """
+        rs = PatchClass.search_any(self, patterns, start, end)
+        return (-1, -1) if rs is None else (rs[0], rs[1].start())
+
+    @staticmethod
+    def replace(self, pat, new=None, count=-1):
+        if isinstance(pat, _pattern_types):
+            if count == 0:
+                return self[:]
+            if len(self) >= NATIVE_MIN_LENGTH:
+                pat = literal_route(pat, self) or pat
+            rs = pat.sub(new, self, max(count or 0, 0))
+            return bytearray(rs) if isinstance(self, bytearray) else rs
+        if isinstance(pat, _RULES):
+            # A set of (pattern, replacement) rules.
+            if new is not None:
+                raise TypeError('replace() takes no replacement with rules')
+            if count == 0:
+                return self[:]
+            rs = get_replace_rules(pat).sub(self, max(count or 0, 0))
+            return bytearray(rs) if isinstance(self, bytearray) else rs
+        return __builtin_methods__[self.__class__]['replace'](
+            self, pat, new, count)
 
     @staticmethod
-    def split(self, sep=None, maxsplit=None):
-        if isinstance(sep, re._pattern_type):
-            return sep.split(self, maxsplit or 0)
-        return get_builtin_method(self.__class__, 'split')(
-            self, sep, maxsplit or -1)
+    def split(self, sep=None, maxsplit=-1):
+        if isinstance(sep, _pattern_types):
+            if maxsplit == 0:
+                return [self[:]]
+            if len(self) >= NATIVE_MIN_LENGTH:
+                sep = literal_route(sep, self) or sep
+            return _like(self, sep.split(self, max(maxsplit or 0, 0)))
+        return __builtin_methods__[self.__class__]['split'](
+            self, sep, maxsplit)
 
     @staticmethod
-    def rsplit(self, sep=None, maxsplit=None):
-        if isinstance(sep, re._pattern_type):
-            maxsplit = maxsplit or 0
-            if maxsplit > 0:
-                pat, flags = sep.pattern, sep.flags
-                pat = re.compile('(' + pat.strip('()') + ')', flags)
-                rs = pat.split(self)
-                if len(rs) > 2*maxsplit + 1:
-                    rs[:-2*maxsplit] = [self[0:0].join(rs[:-2*maxsplit])]
-                    rs[-2*maxsplit:] = rs[-2*maxsplit+1::2]
-            else: rs = sep.split(self)
-            return rs
-        return get_builtin_method(self.__class__, 'rsplit')(
-            self, sep, maxsplit or -1)
+    def rsplit(self, sep=None, maxsplit=-1):
+        if isinstance(sep, _pattern_types):
+            if maxsplit is None or maxsplit < 0:
+                return _like(self, sep.split(self))
+            return split_matches(self, last_matches(sep, self, maxsplit))
+        return __builtin_methods__[self.__class__]['rsplit'](
+            self, sep, maxsplit)
+
+    @staticmethod
+    def isplit(self, sep=None, maxsplit=-1):
+        """Like `split`, but yield the pieces one at a time."""
+        _check_separator(self, sep)
+        if maxsplit is None: maxsplit = -1
+        return _isplit(self, sep, maxsplit)
+
+    @staticmethod
+    def irsplit(self, sep=None, maxsplit=-1):
+        """Like `rsplit`, but yield the pieces one at a time from the last
+        one, in the reverse order of the list `rsplit` returns.
+        """
+        _check_separator(self, sep)
+        if maxsplit is None: maxsplit = -1
+        return _irsplit(self, sep, maxsplit)
+
+    @staticmethod
+    def grep(self, pat, flags=0, index=None):
+        """Yield a (line, column, match) tuple for every match.
+
+        `index` is the `LineIndex` of the string, to share between several
+        calls. Without it one is built at the first match, for this call.
+        """
+        if index is not None and index.string is not self:
+            raise ValueError('index is the LineIndex of another string')
+        return _grep(self, compile(pat, flags), index)
 
     @staticmethod
     def find(self, pat, start=0, end=None):
-        if isinstance(pat, re._pattern_type):
+        if isinstance(pat, _pattern_types):
+            spans = span_cache.maxbytes and cached_spans(pat, self, end)
+            if spans:
+                pos = spans.find(start)
+                if pos is not None:
+                    return pos
             if end is None: end = len(self)
+            literal = len(self) >= NATIVE_MIN_LENGTH and \
+                literal_route(pat, self)
+            if literal:
+                return literal.find(self, start, end)
             res = pat.search(self, start, end)
             return res.start() if res else -1
-        return get_builtin_method(self.__class__, 'find')(
+        return __builtin_methods__[self.__class__]['find'](
             self, pat, start, end)
 
     @staticmethod
     def rfind(self, pat, start=0, end=None):
-        if isinstance(pat, re._pattern_type):
+        if isinstance(pat, _pattern_types):
+            spans = span_cache.maxbytes and cached_spans(pat, self, end)
+            if spans:
+                pos = spans.rfind(start)
+                if pos is not None:
+                    return pos
             if end is None: end = len(self)
-            try:
-                return max(m.start() for m in pat.finditer(self, start, end))
-            except ValueError:
-                return -1
-        return get_builtin_method(self.__class__, 'rfind')(
+            rs = last_matches(pat, self, 1, start, end)
+            return rs[0].start() if rs else -1
+        return __builtin_methods__[self.__class__]['rfind'](
             self, pat, start, end)
 
     @staticmethod
     def count(self, pat, start=0, end=None):
-        if end is None: end = len(self)
-        if isinstance(pat, re._pattern_type):
-            return len(pat.findall(self, start, end))
-        return get_builtin_method(self.__class__, 'count')(
+        if isinstance(pat, _pattern_types):
+            spans = span_cache.maxbytes and cached_spans(pat, self, end)
+            if spans:
+                n = spans.count(start)
+                if n is not None:
+                    return n
+            return count_matches(pat, self, start, end)
+        return __builtin_methods__[self.__class__]['count'](
             self, pat, start, end)
 
     @staticmethod
     def partition(self, sep):
-        if isinstance(sep, re._pattern_type):
-            pat, flags = sep.pattern, sep.flags
-            pat = re.compile('(' + pat.strip('()') + ')', flags)
-            rs = pat.split(self, 1)
-            rs.extend([self[0:0]] * (3-len(rs)))
-            return tuple(rs)
-        return get_builtin_method(self.__class__, 'partition')(self, sep)
+        if isinstance(sep, _pattern_types):
+            spans = span_cache.maxbytes and cached_spans(sep, self)
+            if spans:
+                if not spans.starts:
+                    return self[:], self[0:0], self[0:0]
+                start, end = spans.starts[0], spans.ends[0]
+                return self[:start], self[start:end], self[end:]
+            literal = len(self) >= NATIVE_MIN_LENGTH and \
+                literal_route(sep, self)
+            if literal:
+                return __builtin_methods__[self.__class__]['partition'](
+                    self, literal.pattern)
+            # Slices rather than `m.group()`, a bytearray gets bytearrays
+            # back like from its own method, copies included.
+            m = sep.search(self)
+            if m is None:
+                return self[:], self[0:0], self[0:0]
+            start, end = m.span()
+            return self[:start], self[start:end], self[end:]
+        return __builtin_methods__[self.__class__]['partition'](self, sep)
 
     @staticmethod
     def rpartition(self, sep):
-        if isinstance(sep, re._pattern_type):
-            pat, flags = sep.pattern, sep.flags
-            pat = re.compile('(' + pat.strip('()') + ')', flags)
-            rs = pat.split(self)
-            if len(rs) > 3:
-                rs[:-2] = [self[0:0].join(rs[:-2])]
-            rs = [self[0:0]] * (3-len(rs)) + rs
-            return tuple(rs)
-        return get_builtin_method(self.__class__, 'rpartition')(self, sep)
+        if isinstance(sep, _pattern_types):
+            rs = last_matches(sep, self, 1)
+            if not rs:
+                return self[0:0], self[0:0], self[:]
+            start, end = rs[0].span()
+            return self[:start], self[start:end], self[end:]
+        return __builtin_methods__[self.__class__]['rpartition'](self, sep)
 
     @staticmethod
     def index(self, pat, start=0, end=None):
-        if isinstance(pat, re._pattern_type):
-            if end is None: end = len(self)
-            try:
-                return pat.search(self, start, end).start()
-            except AttributeError:
+        if isinstance(pat, _pattern_types):
+            pos = PatchClass.find(self, pat, start, end)
+            if pos < 0:
                 raise ValueError('substring not found')
-        return get_builtin_method(self.__class__, 'index')(
+            return pos
+        return __builtin_methods__[self.__class__]['index'](
             self, pat, start, end)
 
     @staticmethod
     def rindex(self, pat, start=0, end=None):
-        if isinstance(pat, re._pattern_type):
-            if end is None: end = len(self)
-            try:
-                return max(m.start() for m in pat.finditer(self, start, end))
-            except ValueError:
+        if isinstance(pat, _pattern_types):
+            pos = PatchClass.rfind(self, pat, start, end)
+            if pos < 0:
                 raise ValueError('substring not found')
-        return get_builtin_method(self.__class__, 'rindex')(
+            return pos
+        return __builtin_methods__[self.__class__]['rindex'](
             self, pat, start, end)
 
     @staticmethod
     def startswith(self, prefix, start=0, end=None):
+        if not isinstance(prefix, _tuple_or_pattern):
+            return __builtin_methods__[self.__class__]['startswith'](
+                self, prefix, start, end)
         if end is None: end = len(self)
-        if not isinstance(prefix, tuple):
-            prefix = [prefix]
-        for p in prefix:
-            if isinstance(p, re._pattern_type):
-                if p.match(self, start, end) is not None: return True
-            elif get_builtin_method(self.__class__, 'startswith')(
-                self, p, start, end):
-                 return True
-        return False
+        if isinstance(prefix, _pattern_types):
+            return prefix.match(self, start, end) is not None
+        ps = get_pattern_set(prefix, literal=True)
+        if ps.literals and __builtin_methods__[self.__class__]['startswith'](
+                self, ps.literals, start, end):
+            return True
+        return ps.match(self, start, end) >= 0
 
     @staticmethod
     def endswith(self, suffix, start=0, end=None):
+        if not isinstance(suffix, _tuple_or_pattern):
+            return __builtin_methods__[self.__class__]['endswith'](
+                self, suffix, start, end)
         if end is None: end = len(self)
-        if not isinstance(suffix, tuple):
-            suffix = [suffix]
-        for p in suffix:
-            if isinstance(p, re._pattern_type):
-                pat, flags = p.pattern, p.flags
-                p = re.compile(pat.rstrip('$') + '$', flags)
-                if p.search(self, start, end) is not None: return True
-            elif get_builtin_method(self.__class__, 'endswith')(
-                self, p, start, end):
-                 return True
-        return False
+        if isinstance(suffix, _pattern_types):
+            return get_pattern_ops(suffix).endswith(self, start, end)
+        ps = get_pattern_set(suffix, literal=True)
+        if ps.literals and __builtin_methods__[self.__class__]['endswith'](
+                self, ps.literals, start, end):
+            return True
+        return ps.endswith(self, start, end)
 
 methods_to_patch = [
     'match', 'search', 'findall', 'finditer', 'replace', 'split', 'rsplit',
     'find', 'rfind', 'index', 'rindex', 'partition', 'rpartition', 'count',
-    'startswith', 'endswith'
+    'startswith', 'endswith', 'find_spans', 'search_any', 'find_any',
+    'isplit', 'irsplit', 'grep'
 ]
 
+string_types = [str, bytes, bytearray] if IS_PY3 else \
+    [str, __builtin__.unicode, bytearray]
+# The types whose native methods return the same pieces as `re` does.
+_literal_types = frozenset(string_types[:2])
+
+# Methods patched by gorella, keyed by the patched class.
+__patched__ = defaultdict(set)
+
+
+@_synchronized
+def patch(methods=None, types=None):
+    """Monkey patch regular expression `methods` to the string `types`.
+
+    Both default to everything gorella supports. Return the list of
+    (type, method) pairs that were not patched before.
+    """
+    done = []
+    for klass in types or string_types:
+        for meth in methods or methods_to_patch:
+            if meth not in __patched__[klass]:
+                curse(klass, meth, implementation(meth))
+                __patched__[klass].add(meth)
+                done.append((klass, meth))
+    return done
+
+
+@_synchronized
+def unpatch(methods=None, types=None):
+    """Restore the original `methods` of the string `types`."""
+    for klass in types or string_types:
+        for meth in methods or methods_to_patch:
+            if meth in __patched__[klass]:
+                reverse(klass, meth)
+                __patched__[klass].discard(meth)
+
 
 def patch_all():
     """Monkey patch regular expression methods to `str`."""
-    to_patch = ['str'] if IS_PY3 else ['str', 'unicode']
-    to_patch = [getattr(__builtin__, klass) for klass in to_patch]
-    for klass in to_patch:
-        for meth in methods_to_patch:
-            curse(klass, meth, getattr(PatchClass, meth))
-
-patch_all()
-del patch_all, PatchClass
+    patch()
+
+
+def unpatch_all():
+    """Restore all the original methods of `str`."""
+    unpatch()
+
+
+class patched(object):
+    """Patch `methods` only within a `with` block.
+
+    Methods that were already patched on entering are left alone.
+    """
+    def __init__(self, methods=None, types=None):
+        self.methods = methods
+        self.types = types
+
+    def __enter__(self):
+        self.done = patch(self.methods, self.types)
+
+    def __exit__(self, *exc_info):
+        for klass, meth in self.done:
+            unpatch([meth], [klass])
+
+
+def implementation(meth):
+    """Return the function to install for the patched method `meth`."""
+    func = getattr(PatchClass, meth)
+    if budget.enabled:
+        func = budget.wrap(meth, func)
+    if stats.enabled:
+        func = stats.instrument(meth, func)
+    return func
+
+
+@_synchronized
+def _reinstall():
+    # Swap the functions of the methods already patched, the originals
+    # stashed by `curse` stay where they are.
+    for klass, methods in __patched__.items():
+        dikt = patchable_builtin(klass)
+        for meth in methods:
+            dikt[meth] = implementation(meth)
+        ctypes.pythonapi.PyType_Modified(ctypes.py_object(klass))
+
+
+def _pattern_keys(arg):
+    if isinstance(arg, _pattern_types):
+        return [arg.pattern]
+    if isinstance(arg, dict):
+        arg = tuple(arg)
+    if isinstance(arg, (tuple, list)):
+        return [p.pattern for p in arg if isinstance(p, _pattern_types)] + \
+            [p[0].pattern for p in arg if isinstance(p, tuple) and p and
+             isinstance(p[0], _pattern_types)]
+    return []
+
+
+class Counters(object):
+    """The statistics recorded by one thread."""
+    __slots__ = ('calls', 'regex_calls', 'time', 'patterns')
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.regex_calls = defaultdict(int)
+        self.time = defaultdict(float)
+        self.patterns = defaultdict(int)
+
+
+class Stats(object):
+    """Call statistics of the patched methods.
+
+    The counting wrappers are only installed while the statistics are
+    enabled, the patched methods cost nothing more otherwise. Every thread
+    counts apart, the counters are only added up by `snapshot`.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self._counters = {}
+
+    def counters(self):
+        """Return the counters of the current thread."""
+        ident = get_ident()
+        try:
+            return self._counters[ident]
+        except KeyError:
+            return self._counters.setdefault(ident, Counters())
+
+    def totals(self):
+        """Return the counters of all the threads added up."""
+        total = Counters()
+        for counters in list(self._counters.values()):
+            for name in Counters.__slots__:
+                into = getattr(total, name)
+                for key, value in getattr(counters, name).copy().items():
+                    into[key] += value
+        return total
+
+    def instrument(self, meth, func):
+        @wraps(func)
+        def method(self_, *args, **kwargs):
+            started = _timer()
+            try:
+                return func(self_, *args, **kwargs)
+            finally:
+                try:
+                    self.record(meth, self_, args, kwargs,
+                                _timer() - started)
+                except Exception:  # Counting must not fail the call
+                    pass
+        return method
+
+    def record(self, meth, string, args, kwargs, elapsed):
+        arg = args[0] if args else next(iter(kwargs.values()), None)
+        keys = _pattern_keys(arg)
+        try:
+            extension = meth not in __builtin_methods__[string.__class__]
+        except KeyError:
+            extension = True
+        if not keys and extension:
+            # Patterns given as strings, alone or in a sequence.
+            items = arg if isinstance(arg, (tuple, list)) else [arg]
+            keys = [p for p in items if type(p) in _literal_types]
+        counters = self.counters()
+        counters.calls[meth] += 1
+        counters.time[meth] += elapsed
+        if keys or extension:
+            counters.regex_calls[meth] += 1
+        for key in keys:
+            counters.patterns[key] += 1
+
+    def snapshot(self, top=10):
+        """Return the statistics as a dict.
+
+        `methods` maps every called method to its number of `calls`, how
+        many went through the `regex` path or the `builtin` method and the
+        cumulated `time` in seconds. `patterns` lists the `top` most used
+        patterns with their number of uses.
+        """
+        total = self.totals()
+        methods = {}
+        for meth, calls in total.calls.items():
+            regex = total.regex_calls[meth]
+            methods[meth] = {'calls': calls, 'regex': regex,
+                             'builtin': calls - regex,
+                             'time': total.time[meth]}
+        patterns = sorted(total.patterns.items(), key=lambda p: -p[1])
+        return {'methods': methods, 'patterns': patterns[:top]}
+
+stats = Stats()
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+def enable_stats():
+    """Start recording call statistics of the patched methods."""
+    stats.enabled = True
+    _reinstall()
+
+
+def disable_stats():
+    """Stop recording call statistics, the recorded ones are kept."""
+    stats.enabled = False
+    _reinstall()
+
+
+class RegexTimeout(RuntimeError):
+    """A patched method ran over its time budget."""
+
+
+# Methods whose results can't be sent back by the worker process, the
+# worker only proves they finish in time and they are run again in place.
+# `bulk` rejects them.
+_LOCAL_RESULTS = frozenset(['match', 'search', 'finditer', 'search_any',
+                            'isplit', 'irsplit', 'grep'])
+# Extension methods taking patterns given as strings.
+_PATTERN_METHODS = frozenset(['match', 'search', 'findall', 'finditer',
+                              'find_spans', 'search_any', 'find_any', 'grep'])
+
+
+def _is_regex_call(meth, args, kwargs):
+    arg = args[0] if args else next(iter(kwargs.values()), None)
+    if meth in _PATTERN_METHODS or isinstance(arg, _pattern_types) or \
+            meth == 'replace' and isinstance(arg, _RULES):
+        return True
+    # Tuples of plain strings go to the built-in startswith and endswith.
+    return isinstance(arg, tuple) and \
+        any(isinstance(p, _pattern_types) for p in arg)
+
+
+def _worker_main(conn):
+    while True:
+        try:
+            meth, string, args, kwargs = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = getattr(PatchClass, meth)(string, *args, **kwargs)
+            if meth in _LOCAL_RESULTS:
+                if hasattr(result, '__iter__') and \
+                        not isinstance(result, tuple):
+                    deque(result, 0)
+                result = None
+        except Exception as e:
+            conn.send((False, e))
+        else:
+            conn.send((True, result))
+
+
+class RegexWorker(object):
+    """A process running the regex paths of the patched methods under a
+    time budget.
+
+    It is started on first use, and killed when a call runs over its
+    budget, a new one is started by the next call. Calls from several
+    threads are run one at a time.
+    """
+    def __init__(self):
+        # Imported here rather than under the lock, see `TimeBudget.pause`.
+        import threading
+        import multiprocessing
+        import multiprocessing.connection
+        self.process = self.conn = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        import multiprocessing
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main,
+                                               args=(child,))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.conn.close()
+            self.process = self.conn = None
+
+    def call(self, meth, string, args, kwargs, timeout):
+        """Call the patched method `meth`, raise RegexTimeout if it takes
+        more than `timeout` seconds.
+
+        Calls with arguments that can't be pickled, like the functions
+        passed to `replace`, can't be sent to the worker and are run in
+        place, without a time limit.
+        """
+        from pickle import PicklingError
+        paused = budget.pause()
+        try:
+            with self._lock:
+                if self.process is None:
+                    self.start()
+                try:
+                    self.conn.send((meth, string, args, kwargs))
+                except (PicklingError, AttributeError, TypeError):
+                    # Nothing was written, the worker is still waiting.
+                    ok = value = None
+                else:
+                    if not self.conn.poll(timeout):
+                        self.stop()
+                        raise RegexTimeout('%s took more than %ss'
+                                           % (meth, timeout))
+                    ok, value = self.conn.recv()
+        finally:
+            budget.resume(paused)
+        if ok is False:
+            raise value
+        if ok is None or meth in _LOCAL_RESULTS:
+            return getattr(PatchClass, meth)(string, *args, **kwargs)
+        return value
+
+# Created on first use, see `get_worker`.
+_worker = None
+
+
+def get_worker():
+    global _worker
+    if _worker is None:
+        paused = budget.pause()
+        try:
+            _worker = RegexWorker()
+        finally:
+            budget.resume(paused)
+    return _worker
+
+
+class TimeBudget(object):
+    """Time limits of the regex paths of the patched methods.
+
+    `limit` applies everywhere, `time_limit` blocks override it in their
+    thread. The limiting wrappers are only installed while there is a
+    limit, the patched methods cost nothing more otherwise.
+    """
+    def __init__(self):
+        self.limit = None
+        self.blocks = 0
+        self._local = None
+
+    @property
+    def enabled(self):
+        return self.limit is not None or self.blocks > 0
+
+    @property
+    def local(self):
+        if self._local is None:
+            import threading
+            self._local = threading.local()
+        return self._local
+
+    def current(self):
+        """The limit of the calls made by the current thread, or None."""
+        local = self.local
+        if getattr(local, 'paused', False):
+            return None
+        return getattr(local, 'limit', self.limit)
+
+    def pause(self):
+        """Lift the limits of the current thread until `resume`, return
+        the value to pass to it.
+
+        The worker pauses them while it calls the patched methods itself,
+        through imports or pickling, which would otherwise wait for it.
+        """
+        local = self.local
+        paused = getattr(local, 'paused', False)
+        local.paused = True
+        return paused
+
+    def resume(self, paused):
+        self.local.paused = paused
+
+    def wrap(self, meth, func):
+        @wraps(func)
+        def method(self_, *args, **kwargs):
+            timeout = self.current()
+            if timeout is None or not _is_regex_call(meth, args, kwargs):
+                return func(self_, *args, **kwargs)
+            return get_worker().call(meth, self_, args, kwargs, timeout)
+        return method
+
+budget = TimeBudget()
+
+
+def set_time_limit(seconds):
+    """Limit the regex paths of the patched methods to `seconds`, a call
+    running longer raises RegexTimeout. None removes the limit.
+    """
+    budget.limit = seconds
+    _reinstall()
+
+
+class time_limit(object):
+    """Limit the regex paths of the patched methods called by the current
+    thread to `seconds` within a `with` block.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __enter__(self):
+        local = budget.local
+        self.previous = local.__dict__.get('limit', self)
+        local.limit = self.seconds
+        budget.blocks += 1
+        if budget.blocks == 1 and budget.limit is None:
+            _reinstall()
+
+    def __exit__(self, *exc_info):
+        local = budget.local
+        if self.previous is self:
+            del local.limit
+        else:
+            local.limit = self.previous
+        budget.blocks -= 1
+        if not budget.enabled:
+            _reinstall()
+
+
+def call_with_timeout(method, string, args=(), kwargs=None, timeout=None):
+    """Call the patched `method` on `string` with a time budget, whether
+    the methods are patched or not.
+
+    `timeout` defaults to the current limit, without any the method is
+    called in place.
+    """
+    kwargs = kwargs or {}
+    if timeout is None:
+        timeout = budget.current()
+    if timeout is None:
+        return getattr(PatchClass, method)(string, *args, **kwargs)
+    return get_worker().call(method, string, args, kwargs, timeout)
+
+
+def call_async(method, string, args=(), kwargs=None, timeout=None):
+    """Return an awaitable of `call_with_timeout(...)`.
+
+    The call is made by the default executor of the running event loop, a
+    thread waiting for the worker process, so the loop isn't blocked.
+    """
+    import asyncio
+    try:
+        loop = asyncio.get_running_loop()
+    except (AttributeError, RuntimeError):  # Python < 3.7, or no loop
+        loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, call_with_timeout, method, string,
+                                args, kwargs, timeout)
+
+
+class BacktrackingWarning(UserWarning):
+    """A pattern is prone to catastrophic backtracking."""
+
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+# Constructs the engine never backtracks into.
+_ATOMIC = tuple(getattr(sre_constants, name) for name in
+                ('POSSESSIVE_REPEAT', 'ATOMIC_GROUP')
+                if hasattr(sre_constants, name))
+
+
+def backtracking_risks(pattern, flags=0):
+    """Return the descriptions of the parts of `pattern` prone to
+    catastrophic backtracking: unbounded repeats nested in unbounded
+    repeats, like `(a+)+` or `(\\w+\\s?)*`.
+    """
+    try:
+        tree = get_pattern_ops(compile(pattern, flags)).parse()
+    except ValueError:  # Patterns of the other engines
+        return []
+    risks = []
+    _find_risks(tree, False, risks)
+    return risks
+
+
+def _find_risks(tree, nested, risks):
+    for op, av in tree:
+        if op in _REPEATS:
+            low, high, body = av
+            unbounded = high >= sre_constants.MAXREPEAT
+            if unbounded and nested and body.getwidth()[1] > 0:
+                risks.append('unbounded repeat of %s nested in an unbounded '
+                             'repeat' % _describe(body))
+            _find_risks(body, nested or unbounded, risks)
+            continue
+        for sub in _subpatterns(av):
+            _find_risks(sub, nested and op not in _ATOMIC, risks)
+
+
+def _subpatterns(av):
+    for item in av if isinstance(av, (tuple, list)) else [av]:
+        if isinstance(item, sre_parse.SubPattern):
+            yield item
+        elif isinstance(item, (tuple, list)):
+            for sub in item:
+                if isinstance(sub, sre_parse.SubPattern):
+                    yield sub
+
+
+def _describe(tree):
+    ops = [str(op).lower() for op, av in tree]
+    return ' '.join(ops[:3]) + (' ...' if len(ops) > 3 else '')
+
+
+def warn_backtracking(pattern):
+    """Warn with a BacktrackingWarning if a compiled pattern is prone to
+    catastrophic backtracking.
+    """
+    risks = backtracking_risks(pattern)
+    if risks:
+        import warnings
+        warnings.warn('%r: %s' % (pattern.pattern, '; '.join(risks)),
+                      BacktrackingWarning, stacklevel=3)
+
+
+class StreamMatch(object):
+    """A match found by the stream functions.
+
+    It wraps the match object of the chunk it was found in and reports
+    offsets from the beginning of the stream.
+    """
+    __slots__ = ('match', 'offset')
+
+    def __init__(self, match, offset):
+        self.match = match
+        self.offset = offset
+
+    def start(self, group=0):
+        start = self.match.start(group)
+        return start + self.offset if start >= 0 else start
+
+    def end(self, group=0):
+        end = self.match.end(group)
+        return end + self.offset if end >= 0 else end
+
+    def span(self, group=0):
+        return self.start(group), self.end(group)
+
+    def group(self, *groups):
+        return self.match.group(*groups)
+
+    def groups(self, default=None):
+        return self.match.groups(default)
+
+    def groupdict(self, default=None):
+        return self.match.groupdict(default)
+
+    def __repr__(self):
+        return '<StreamMatch span=%r, match=%r>' % (self.span(), self.group())
+
+
+def map_file(path):
+    """Memory-map the file at `path` read-only for the stream functions."""
+    import mmap
+    with open(path, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty files can't be mapped
+            return b''
+
+
+def iter_chunks(source, chunk_size=1 << 16):
+    """Yield the chunks of a file-like object or an iterable of chunks."""
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        for chunk in source:
+            yield chunk
+
+
+def _is_buffer(source):
+    if isinstance(source, tuple(string_types)):
+        return True
+    try:
+        memoryview(source)
+    except TypeError:
+        return False
+    return True
+
+
+def _scan_chunks(pattern, chunks, max_match, pieces=False):
+    # Matches starting less than `max_match` characters before the end of
+    # the buffer may change with more data, they are looked for again once
+    # the next chunk arrives. The same amount of text is kept before the
+    # scan position for look-behinds. With `pieces`, yield the text before
+    # every match along with it, and the text after the last one.
+    buf, base, pos, last_empty = None, 0, 0, -1
+    head, held = 0, []
+    final = False
+    chunks = chain(chunks, [None])
+    for chunk in chunks:
+        if chunk is None:
+            if buf is None:
+                buf = pattern.pattern[:0]
+            final = True
+        elif not chunk:
+            continue
+        else:
+            buf = chunk if buf is None else buf + chunk
+        limit = len(buf) + 1 if final else len(buf) - max_match
+        for m in pattern.finditer(buf, pos):
+            if m.start() >= limit:
+                break
+            if m.start() == m.end():
+                if base + m.start() == last_empty:
+                    continue
+                last_empty = base + m.start()
+            if pieces:
+                held.append(buf[head:m.start()])
+                yield buf[:0].join(held), StreamMatch(m, base)
+                held, head = [], m.end()
+            else:
+                yield StreamMatch(m, base)
+            pos = m.end()
+        if final:
+            break
+        cut = max(pos, limit)
+        keep = max(cut - max_match, 0)
+        if head < keep:
+            held.append(buf[head:keep])
+            head = keep
+        buf, base, pos, head = buf[keep:], base + keep, cut - keep, head - keep
+    if pieces:
+        held.append(buf[head:])
+        yield buf[:0].join(held), None
+
+
+def stream_finditer(pattern, source, flags=0, chunk_size=1 << 16,
+                    max_match=1024):
+    """Yield the matches of `pattern` in a stream as `StreamMatch` objects.
+
+    `source` is a string, a buffer such as a memory-mapped file (see
+    `map_file`), a file-like object or an iterable of chunks. Buffers are
+    scanned in place, other sources chunk by chunk, keeping at most
+    `chunk_size` plus twice `max_match` characters in memory. Matches, and
+    the look-behinds of the pattern, must not be longer than `max_match`.
+    """
+    pattern = compile(pattern, flags)
+    if _is_buffer(source):
+        return (StreamMatch(m, 0) for m in pattern.finditer(source))
+    return _scan_chunks(pattern, iter_chunks(source, chunk_size), max_match)
+
+
+def stream_search(pattern, source, flags=0, chunk_size=1 << 16,
+                  max_match=1024):
+    """Return the first match of `pattern` in a stream, or None."""
+    for m in stream_finditer(pattern, source, flags, chunk_size, max_match):
+        return m
+
+
+def stream_findall(pattern, source, flags=0, chunk_size=1 << 16,
+                   max_match=1024):
+    """Yield what `re.findall` would return for the matches in a stream."""
+    for m in stream_finditer(pattern, source, flags, chunk_size, max_match):
+        groups = m.groups()
+        if not groups:
+            yield m.group()
+        elif len(groups) == 1:
+            yield groups[0]
+        else:
+            yield groups
+
+
+def stream_split(pattern, source, flags=0, chunk_size=1 << 16,
+                 max_match=1024):
+    """Yield the pieces of a stream split by `pattern` like `re.split`.
+
+    Only the current piece is kept in memory, it is as large as the text
+    between two matches.
+    """
+    pattern = compile(pattern, flags)
+    if _is_buffer(source):
+        pos = 0
+        for m in pattern.finditer(source):
+            yield source[pos:m.start()]
+            for group in m.groups():
+                yield group
+            pos = m.end()
+        yield source[pos:]
+        return
+    chunks = iter_chunks(source, chunk_size)
+    for piece, m in _scan_chunks(pattern, chunks, max_match, pieces=True):
+        yield piece
+        if m is not None:
+            for group in m.groups():
+                yield group
+
+
+def byte_view(buffer):
+    """Return a flat memoryview of the bytes of `buffer`, a bytes-like
+    object, a memoryview or a mmap.
+
+    The view keeps `buffer` exported, a mmap can't be closed before the
+    views taken from it are released.
+    """
+    view = memoryview(buffer)
+    if view.ndim != 1 or view.format != 'B':
+        view = view.cast('B')
+    return view
+
+
+def buffer_find(pattern, buffer, start=0, end=None, flags=0):
+    """Return the offset of the first match of `pattern` in `buffer`, or
+    -1, without copying the buffer.
+    """
+    view = byte_view(buffer)
+    if end is None: end = len(view)
+    m = compile(pattern, flags).search(view, start, end)
+    return -1 if m is None else m.start()
+
+
+def buffer_spans(pattern, buffer, start=0, end=None, flags=0):
+    """Return the offsets of all matches of `pattern` in `buffer` as a flat
+    array of (start, end) pairs, like `find_spans`.
+    """
+    return PatchClass.find_spans(byte_view(buffer), compile(pattern, flags),
+                                 start, end)
+
+
+def buffer_views(pattern, buffer, flags=0):
+    """Yield a memoryview of every match of `pattern` in `buffer`.
+
+    The views share the memory of `buffer`, unlike the groups of a match
+    object that are copied to bytes.
+    """
+    view = byte_view(buffer)
+    for m in compile(pattern, flags).finditer(view):
+        yield view[m.start():m.end()]
+
+
+def buffer_split(pattern, buffer, maxsplit=0, flags=0):
+    """Yield memoryviews of the pieces of `buffer` between the matches of
+    `pattern`.
+
+    Unlike `re.split` the groups of the pattern are not yielded, they could
+    only be copies.
+    """
+    view = byte_view(buffer)
+    pos = 0
+    matches = compile(pattern, flags).finditer(view)
+    if maxsplit > 0:
+        matches = islice(matches, maxsplit)
+    for m in matches:
+        yield view[pos:m.start()]
+        pos = m.end()
+    yield view[pos:]
+
+
+# The patched method run by a bulk worker process, with its arguments bound.
+_bulk_call = None
+
+
+def _bulk_init(method, args):
+    global _bulk_call
+    func = getattr(PatchClass, method)
+    _bulk_call = lambda string: func(string, *args)
+
+
+def _bulk_run(chunk):
+    return [_bulk_call(string) for string in chunk]
+
+
+def _chunked(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        chunk = list(islice(iterable, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def bulk(method, strings, args=(), workers=None, chunksize=256,
+         threshold=4096):
+    """Yield the result of the patched `method` called with `args` on every
+    string of `strings`, in order.
+
+    The strings are sent in chunks of `chunksize` to a pool of `workers`
+    processes, which receive the method and its arguments, compiled patterns
+    included, only once. Inputs shorter than `threshold` strings are
+    processed in this process, where starting a pool would cost more.
+    """
+    if method in _LOCAL_RESULTS:
+        raise ValueError('The results of %s can not be sent between '
+                         'processes' % method)
+    func = getattr(PatchClass, method)
+    strings = iter(strings)
+    head = list(islice(strings, threshold))
+    if len(head) < threshold or workers in (0, 1):
+        for string in chain(head, strings):
+            yield func(string, *args)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, _bulk_init, (method, args))
+    try:
+        for results in pool.imap(_bulk_run,
+                                 _chunked(chain(head, strings), chunksize)):
+            for result in results:
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def bulk_findall(pattern, strings, flags=0, **options):
+    """`bulk` version of `str.findall`, see `bulk` for the options."""
+    return bulk('findall', strings, (pattern, flags), **options)
+
+
+def bulk_split(pattern, strings, maxsplit=-1, **options):
+    """`bulk` version of `str.split`, see `bulk` for the options."""
+    return bulk('split', strings, (pattern, maxsplit), **options)
+
+
+def bulk_replace(pattern, new, strings, count=-1, **options):
+    """`bulk` version of `str.replace`, see `bulk` for the options."""
+    return bulk('replace', strings, (pattern, new, count), **options)
+
+if os.environ.get('GORELLA_PATTERN_FILE'):
+    load_pattern_cache(os.environ['GORELLA_PATTERN_FILE'])
+if os.environ.get('GORELLA_STATS', '0') != '0':
+    stats.enabled = True
+if os.environ.get('GORELLA_PATCH', '1') != '0':
+    patch_all()
@@ -1,7 +1,16 @@
 # -*- coding: utf-8 -*-
 import gorella
 import unittest
+import tempfile
+import random
+import io
+import os
 import re
+import sys
+import subprocess
+import warnings
+import asyncio
+import threading
 
 
 class GorellaTestSuite(unittest.TestCase):
@@ -124,6 +133,719 @@ class GorellaTestSuite(unittest.TestCase):
         self.assertFalse("What's your name".endswith(suffix))
         self.assertTrue("What's your name".endswith((suffix, 'e')))
 
+    def test_derived_patterns(self):
+        paren = re.compile(r'\(\d+\)')
+        self.assertEqual('(1) a (2) b'.partition(paren),
+                         ('', '(1)', ' a (2) b'))
+        self.assertEqual('(1) a (2) b'.rpartition(paren),
+                         ('(1) a ', '(2)', ' b'))
+        self.assertEqual('a1b2c3d'.rsplit(re.compile(r'(\d)'), 2),
+                         ['a1b', '2', 'c', '3', 'd'])
+        suffix = re.compile(r'(\w)\1')
+        self.assertTrue('hello'.endswith(re.compile(r'(l)\1o')))
+        self.assertFalse('hello'.endswith(suffix))
+        self.assertFalse('abc\n'.endswith(re.compile('c')))
+        self.assertIs(gorella.get_pattern_ops(suffix),
+                      gorella.get_pattern_ops(suffix))
+
+    def test_reverse_search(self):
+        text = 'a' * 1001 + ' 12 345 ' + 'b' * 1000
+        nums = re.compile(r'\d{1,2}')
+        self.assertEqual(text.rfind(nums), 1007)
+        self.assertEqual(text.rindex(nums, 0, 1006), 1005)
+        self.assertEqual(text.rpartition(nums), (text[:1007], '5', text[1008:]))
+        self.assertEqual(text.rsplit(nums, 2), [text[:1005], '', text[1008:]])
+        pairs = re.compile('aa')
+        self.assertEqual(text.rfind(pairs), 998)
+        self.assertEqual(text.rsplit(pairs, 1), [text[:998], text[1000:]])
+
+    def test_find_spans(self):
+        nums = re.compile(r'\d+')
+        spans = '5 people and 33 apples'.find_spans(nums)
+        self.assertEqual(list(spans), [0, 1, 13, 15])
+        self.assertEqual(spans.itemsize, 8)
+        self.assertEqual(list('5 people and 33 apples'.find_spans(
+            r'\d+', 1)), [13, 15])
+        self.assertEqual(len('hello world'.find_spans(nums)), 0)
+        self.assertEqual('a(b)c(d)'.count(re.compile(r'\((\w)\)')), 2)
+
+    def assertSameResult(self, patched, native, *args):
+        try:
+            expected = native(*args)
+        except Exception as e:
+            self.assertRaises(type(e), patched, *args)
+        else:
+            self.assertEqual(patched(*args), expected, args)
+
+    def test_parity_builtin(self):
+        rnd = random.Random(0)
+        bounds = [None, 0, 1, 3, -1, -4, 100]
+        for _ in range(500):
+            s = ''.join(rnd.choice('ab \n') for _ in range(rnd.randint(0, 12)))
+            sub = ''.join(rnd.choice('ab ') for _ in range(rnd.randint(0, 2)))
+            start, end = rnd.choice(bounds), rnd.choice(bounds)
+            num = rnd.choice([-1, 0, 1, 2, 5])
+            calls = [
+                ('replace', (sub, 'x', num)), ('split', (sub or None, num)),
+                ('rsplit', (sub or None, num)), ('split', ()),
+                ('rsplit', ()), ('partition', (sub,)), ('rpartition', (sub,)),
+                ('startswith', ((sub, 'b'), start, end)),
+                ('endswith', (sub, start, end)),
+            ] + [(name, (sub, start, end)) for name in
+                 ('find', 'rfind', 'index', 'rindex', 'count')]
+            for name, args in calls:
+                self.assertSameResult(getattr(s, name),
+                                      getattr(s, '_c_' + name), *args)
+
+    def test_parity_pattern(self):
+        rnd = random.Random(1)
+        for _ in range(500):
+            s = ''.join(rnd.choice('ab \n') for _ in range(rnd.randint(0, 30)))
+            # Literals that can't overlap themselves are found at the same
+            # places by a regular expression and the C methods.
+            sub = rnd.choice(['a', 'b', ' ', 'ab', ' \n'])
+            pat = re.compile(re.escape(sub))
+            start = rnd.randint(0, 5)
+            end = rnd.choice([None, len(s), rnd.randint(0, 30)])
+            num = rnd.choice([-1, 0, 1, 2, 5])
+            calls = [
+                ('replace', (sub, 'x', num)), ('split', (sub, num)),
+                ('rsplit', (sub, num)), ('partition', (sub,)),
+                ('rpartition', (sub,)), ('startswith', (sub, start, end)),
+                ('endswith', (sub, start, end)),
+            ] + [(name, (sub, start, end)) for name in
+                 ('find', 'rfind', 'index', 'rindex', 'count')]
+            for name, args in calls:
+                method = getattr(s, name)
+                self.assertSameResult(lambda *a: method(pat, *a[1:]),
+                                      getattr(s, '_c_' + name), *args)
+
+    def test_unpatch(self):
+        pat = re.compile(r'\d')
+        try:
+            gorella.unpatch(['find', 'match'])
+            self.assertFalse(hasattr(str, 'match'))
+            self.assertFalse(hasattr(str, '_c_find'))
+            self.assertRaises(TypeError, 'a1'.find, pat)
+            self.assertEqual('a1'.rfind(pat), 1)
+            with gorella.patched(['find', 'rfind']):
+                self.assertEqual('a1'.find(pat), 1)
+            self.assertRaises(TypeError, 'a1'.find, pat)
+            self.assertEqual('a1'.rfind(pat), 1)
+        finally:
+            gorella.patch_all()
+        self.assertEqual('a1'.find(pat), 1)
+        self.assertTrue(hasattr(str, 'match'))
+
+    def test_stream(self):
+        text = 'id=1 ok\nid=22 ok\nid=333 failed\n' * 50
+        nums = re.compile(r'id=(\d+)')
+        chunks = [text[i:i + 7] for i in range(0, len(text), 7)]
+        spans = [m.span() for m in nums.finditer(text)]
+        self.assertEqual([m.span() for m in gorella.stream_finditer(
+            nums, chunks, max_match=10)], spans)
+        self.assertEqual(list(gorella.stream_findall(
+            nums, io.StringIO(text), chunk_size=5, max_match=10)),
+            nums.findall(text))
+        self.assertEqual(list(gorella.stream_split(
+            r'\n', iter(chunks), max_match=1)), text.split('\n'))
+        m = gorella.stream_search(r'(\d+) failed', iter(chunks))
+        self.assertEqual((m.span(), m.group(1)), ((20, 30), '333'))
+        self.assertIsNone(gorella.stream_search('missing', iter(chunks)))
+
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(text.encode('ascii'))
+            mapped = gorella.map_file(path)
+            pat = re.compile(br'id=(\d+)')
+            self.assertEqual([m.span() for m in gorella.stream_finditer(
+                pat, mapped)], spans)
+            with open(path, 'rb') as f:
+                self.assertEqual([m.span(1) for m in gorella.stream_finditer(
+                    pat, f, chunk_size=3, max_match=10)],
+                    [m.span(1) for m in nums.finditer(text)])
+            mapped.close()
+        finally:
+            os.remove(path)
+
+    def test_pattern_sets(self):
+        routes = (re.compile(r'GET /users/(\d+)'), re.compile('(?i)post /'),
+                  re.compile(r'(\w+) /health'))
+        line = 'ts=1 POST /users'
+        self.assertTrue(line.startswith(('ts=', re.compile('x'))))
+        self.assertTrue(line[5:].startswith(routes))
+        self.assertFalse(line.startswith(routes))
+        self.assertTrue(line.endswith((re.compile(r'/\w+'), 'x')))
+        self.assertFalse(line.endswith((re.compile(r'/\d+'), 'x')))
+        index, m = 'at GET /users/42'.search_any(routes)
+        self.assertEqual((index, m.group(1)), (0, '42'))
+        self.assertEqual(line.find_any(routes), (1, 5))
+        self.assertEqual('HEAD /health'.find_any(routes), (2, 0))
+        self.assertEqual('nothing'.find_any(routes), (-1, -1))
+        self.assertIsNone('nothing'.search_any(routes))
+        # Back references can't be combined, patterns are tried in turn.
+        refs = (re.compile(r'(\d)\1'), re.compile('b+'))
+        self.assertIsNone(gorella.get_pattern_set(refs).combined)
+        self.assertEqual('ab11'.find_any(refs), (1, 1))
+        # A pattern with every scoped flag set is combined too.
+        flagged = (re.compile('A . b', re.I | re.M | re.S | re.X),
+                   re.compile('b'))
+        self.assertIsNotNone(gorella.get_pattern_set(flagged).combined)
+        self.assertEqual('xa\nb'.find_any(flagged), (0, 1))
+
+    def test_endswith_tail(self):
+        text = 'x' * 100000 + 'id=42'
+        self.assertTrue(text.endswith(re.compile(r'=\d{1,3}')))
+        self.assertTrue(text.endswith(re.compile(r'[a-z]+=\d+')))
+        self.assertFalse(text.endswith(re.compile(r'y[a-z]*=\d+')))
+        self.assertTrue(text.endswith(re.compile(r'^x+id=\d+')))
+        self.assertTrue(text.endswith(re.compile(r'(x|d)+=4'), 0, len(text) - 1))
+        ops = gorella.get_pattern_ops(re.compile(r'(ab|c)+d*'))
+        self.assertTrue(ops.reversed.match('dcba'))
+        self.assertIsNone(gorella.get_pattern_ops(re.compile('^a')).reversed)
+
+    def test_bulk(self):
+        lines = ['user=%d age=%d' % (i, i % 90) for i in range(300)]
+        nums = re.compile(r'\d+')
+        expected = [line.findall(nums) for line in lines]
+        self.assertEqual(list(gorella.bulk_findall(nums, lines)), expected)
+        self.assertEqual(list(gorella.bulk_findall(
+            nums, iter(lines), workers=2, chunksize=16, threshold=100)),
+            expected)
+        self.assertEqual(list(gorella.bulk_split(
+            re.compile(r'\s'), lines, workers=2, threshold=10)),
+            [line.split(' ') for line in lines])
+        self.assertEqual(list(gorella.bulk_replace(
+            nums, '#', lines, 1, workers=2, threshold=10)),
+            [nums.sub('#', line, 1) for line in lines])
+        self.assertRaises(ValueError, list, gorella.bulk('search', lines))
+        for method in ('isplit', 'irsplit', 'grep'):
+            self.assertRaises(ValueError, list, gorella.bulk(method, lines))
+
+    def test_pattern_cache(self):
+        cache = gorella.PatternCache(2)
+        a = cache.compile('a+')
+        self.assertIs(cache.compile('a+'), a)
+        cache.compile('b+')
+        cache.compile('a+')
+        cache.compile('c+', re.I)
+        self.assertEqual(cache.info(), {'hits': 2, 'misses': 3,
+                                        'evictions': 1, 'size': 2,
+                                        'maxsize': 2})
+        self.assertIs(cache.compile('a+'), a)
+        self.assertEqual(cache.prewarm(['d', ('e', re.I)])[1].flags & re.I,
+                         re.I)
+        self.assertEqual(cache.info()['evictions'], 3)
+        cache.resize(1)
+        self.assertEqual(cache.info()['size'], 1)
+        self.assertRaises(ValueError, cache.compile, a, re.I)
+        self.assertRaises(TypeError, cache.compile, 5)
+        self.assertRaises(TypeError, 'abc'.search, None)
+
+        hits = gorella.pattern_cache.hits
+        self.assertEqual('I am 26'.search(r'\d+$').group(), '26')
+        self.assertEqual('I am 26'.findall(r'\d+$'), ['26'])
+        self.assertEqual(gorella.pattern_cache.hits, hits + 1)
+
+    def test_stats(self):
+        nums = re.compile(r'\d+')
+        # Compiling patterns calls bytearray.find, compile them beforehand.
+        gorella.prewarm([r'\d'])
+        'a1b22'.startswith(('x', nums))
+        gorella.stats.reset()
+        gorella.enable_stats()
+        try:
+            'a1b22'.find(nums)
+            'a1b22'.find('b')
+            'a1b22'.startswith(('x', nums))
+            'a1b22'.findall(r'\d')
+            self.assertEqual('abc'.search_any(['b', 'c'])[0], 0)
+            self.assertEqual('abc'.find_any(['x', re.compile('c')]), (1, 2))
+            snapshot = gorella.stats.snapshot()
+        finally:
+            gorella.disable_stats()
+        self.assertEqual(snapshot['methods']['find']['calls'], 2)
+        self.assertEqual(snapshot['methods']['find']['regex'], 1)
+        self.assertEqual(snapshot['methods']['find']['builtin'], 1)
+        self.assertEqual(snapshot['methods']['findall']['regex'], 1)
+        self.assertEqual(snapshot['methods']['startswith']['regex'], 1)
+        self.assertGreater(snapshot['methods']['find']['time'], 0)
+        self.assertEqual(snapshot['methods']['search_any']['regex'], 1)
+        self.assertEqual(sorted(snapshot['patterns']),
+                         [(r'\d', 1), (r'\d+', 2), ('b', 1), ('c', 2)])
+        self.assertIs(str.__dict__['find'], gorella.PatchClass.find)
+        'a'.find('a')
+        self.assertEqual(gorella.stats.snapshot()['methods']['find']['calls'],
+                         2)
+
+    def test_lazy_import(self):
+        script = ('import sys, gorella; print(gorella.__builtin__.dir is '
+                  'gorella.__dir__, "ctypes" in sys.modules, '
+                  'hasattr(str, "search"))')
+        for value, expected in (('0', 'True False False'),
+                                ('1', 'True True True')):
+            env = dict(os.environ, GORELLA_PATCH=value)
+            output = subprocess.check_output(
+                [sys.executable, '-c', script], env=env)
+            self.assertEqual(output.decode().strip(), expected)
+
+    def test_filtered_dir(self):
+        try:
+            gorella.curse(int, 'gorella_hidden', 1, hide_from_dir=True)
+            self.assertTrue(dir is gorella.__filtered_dir__)
+            self.assertNotIn('gorella_hidden', dir(int))
+            self.assertNotIn('gorella_hidden', dir(1))
+            self.assertEqual(dir('a'), gorella.__dir__('a'))
+            self.assertEqual(dir(None), gorella.__dir__(None))
+            local = 1
+            self.assertEqual(dir(), ['local', 'self'])
+        finally:
+            gorella.reverse(int, 'gorella_hidden')
+        self.assertTrue(dir is gorella.__dir__)
+        self.assertFalse(hasattr(int, 'gorella_hidden'))
+
+    def test_bytes(self):
+        nums = re.compile(br'\d+')
+        for kind in (bytes, bytearray):
+            data = kind(b'id=1;id=22;')
+            self.assertEqual(data.find(nums), 3)
+            self.assertEqual(data.rfind(nums), 8)
+            self.assertEqual(data.split(nums), [b'id=', b';id=', b';'])
+            self.assertEqual(data.count(nums), 2)
+            self.assertEqual(data.replace(nums, b'#'), b'id=#;id=#;')
+            self.assertTrue(data.endswith((b'x', re.compile(br'\d;'))))
+            self.assertEqual(data.findall(br'id=(\d+)'), [b'1', b'22'])
+            self.assertEqual(data.find(b';'), 4)
+            self.assertEqual(type(data.split(b';')[0]), kind)
+            for pieces in (data.partition(nums), data.rpartition(nums),
+                           data.partition(re.compile(b'x')),
+                           data.rpartition(re.compile(b'x'))):
+                self.assertEqual([type(p) for p in pieces], [kind] * 3)
+            self.assertEqual(data.rpartition(nums), (b'id=1;id=', b'22', b';'))
+            # The methods of bytearray return bytearrays, groups included.
+            groups = re.compile(br'=(\d)')
+            for pieces in (data.split(nums), data.split(groups),
+                           data.rsplit(nums), data.rsplit(groups, 1),
+                           list(data.isplit(groups)),
+                           list(data.irsplit(groups, 1)),
+                           data.split(nums, 0), data.rsplit(nums, 0),
+                           [data.replace(nums, b'#'),
+                            data.replace(nums, b'#', 0),
+                            data.replace({b'id': b'ID', nums: b'#'})]):
+                self.assertEqual([type(p) for p in pieces],
+                                 [kind] * len(pieces))
+            self.assertEqual(data.rsplit(groups, 1), [b'id=1;id', b'2', b'2;'])
+            if kind is bytearray:
+                self.assertIsNot(data.partition(re.compile(b'x'))[0], data)
+
+    def test_buffers(self):
+        data = b'id=1;id=22;' * 3
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(data)
+        try:
+            mapped = gorella.map_file(f.name)
+            for buf in (memoryview(data), mapped):
+                self.assertEqual(gorella.buffer_find(br'\d+', buf, 4), 8)
+                self.assertEqual(list(gorella.buffer_spans(br'\d+', buf)),
+                                 list(data.find_spans(br'\d+')))
+                views = list(gorella.buffer_views(br'\d+', buf))
+                self.assertEqual(type(views[0]), memoryview)
+                self.assertEqual([v.tobytes() for v in views],
+                                 data.findall(br'\d+'))
+                pieces = list(gorella.buffer_split(b';', buf, 2))
+                self.assertEqual([p.tobytes() for p in pieces],
+                                 data.split(re.compile(b';'), 2))
+                del views, pieces
+            mapped.close()
+        finally:
+            os.remove(f.name)
+
+    def test_engines(self):
+        lit = gorella.compile('a.', engine='literal')
+        self.assertEqual(lit, gorella.Literal('a.'))
+        self.assertTrue(gorella.compile('a.', engine='literal') is lit)
+        s = 'xa.ya.a'
+        pat = re.compile(re.escape('a.'))
+        for name, args in (('find', ()), ('rfind', ()), ('split', ()),
+                           ('rsplit', (1,)), ('count', ()),
+                           ('partition', ()), ('rpartition', ()),
+                           ('endswith', ()), ('find_spans', ()),
+                           ('findall', ())):
+            self.assertEqual(getattr(s, name)(lit, *args),
+                             getattr(s, name)(pat, *args), name)
+        self.assertEqual(s.replace(lit, r'<\g<0>>'), 'x<a.>y<a.>a')
+        self.assertEqual(s.search(lit).span(), (1, 3))
+        self.assertEqual(s.find_any(('q', lit)), (1, 1))
+        self.assertEqual('aaa'.count(gorella.Literal('aa')), 1)
+        self.assertEqual('aaa'.count(gorella.Literal('aa'), -5, 9), 1)
+        self.assertEqual(gorella.Literal('').findall('ab'), ['', '', ''])
+        self.assertEqual('ab'.split(gorella.Literal('')), re.split('', 'ab'))
+        self.assertRaises(ValueError, gorella.get_engine, 'nope')
+
+        class Wrapped(object):
+            def __init__(self, pattern, flags=0):
+                self.regex = re.compile(pattern, flags)
+
+            def search(self, string, pos=0, endpos=sys.maxsize):
+                return self.regex.search(string, pos, endpos)
+
+        gorella.register_engine('wrapped', Wrapped, Wrapped)
+        try:
+            self.assertEqual('ab1'.find(gorella.compile(
+                r'\d', engine='wrapped')), 2)
+        finally:
+            gorella.unregister_engine('wrapped')
+        self.assertRaises(TypeError, 'ab1'.find, Wrapped(r'\d'))
+
+    def test_literal_patterns(self):
+        ops = gorella.get_pattern_ops
+        self.assertEqual(ops(re.compile(r'a\.b')).literal,
+                         gorella.Literal('a.b'))
+        self.assertEqual(ops(re.compile(br'a\nb')).literal,
+                         gorella.Literal(b'a\nb'))
+        for source, flags in ((r'a(b)', 0), (r'ab', re.I), (r'a.', 0),
+                              (r'', 0), (r'ab|cd', 0)):
+            self.assertEqual(ops(re.compile(source, flags)).literal, None)
+        rnd = random.Random(2)
+        for _ in range(50):
+            s = ''.join(rnd.choice('ab. ') for _ in range(rnd.randint(
+                gorella.NATIVE_MIN_LENGTH, 2 * gorella.NATIVE_MIN_LENGTH)))
+            pat = re.compile(re.escape(rnd.choice(['a.', 'b', 'ab .'])))
+            start, end = rnd.randint(-5, 50), rnd.randint(-5, 600)
+            self.assertEqual(s.find(pat, start, end),
+                             next((m.start() for m in pat.finditer(
+                                 s, start, end)), -1))
+            self.assertEqual(s.count(pat, start, end),
+                             len(pat.findall(s, start, end)))
+            self.assertEqual(s.split(pat, 3), pat.split(s, 3))
+            self.assertEqual(s.replace(pat, r'<\g<0>>', 2),
+                             pat.sub(r'<\g<0>>', s, 2))
+            self.assertEqual(s.partition(pat), s._c_partition(
+                pat.pattern.replace('\\', '')))
+
+    def test_lazy_split(self):
+        rnd = random.Random(3)
+        patterns = [re.compile(r'b'), re.compile(r'(a)b?'),
+                    re.compile(r'\s'), re.compile(r'x*'),
+                    re.compile(r'a[ b]+'), re.compile(r'(?<=a)b')]
+        for _ in range(100):
+            s = ''.join(rnd.choice('ab \n') for _ in range(
+                rnd.choice([0, 5, 40, 3000])))
+            if rnd.random() < 0.2:
+                s = 'a' * 600 + ' ' + s + '\n' * 300
+            num = rnd.choice([-1, 0, 1, 2, 5, None])
+            for sep in [None, ' ', 'ab', 'a a'] + patterns:
+                if sep is None or isinstance(sep, str):
+                    split, rsplit = s._c_split, s._c_rsplit
+                else:
+                    split, rsplit = s.split, s.rsplit
+                maxsplit = -1 if num is None else num
+                self.assertEqual(list(s.isplit(sep, num)),
+                                 split(sep, maxsplit), (s, sep, num))
+                self.assertEqual(list(s.irsplit(sep, num)),
+                                 rsplit(sep, maxsplit)[::-1], (s, sep, num))
+        pieces = ('x,' * 100000).isplit(',')
+        self.assertEqual([next(pieces), next(pieces)], ['x', 'x'])
+        self.assertEqual(next(b'a b c'.irsplit()), b'c')
+        self.assertRaises(ValueError, 'abc'.isplit, '')
+        self.assertRaises(TypeError, 'abc'.irsplit, 1)
+        # Only the lazy methods patched, the others are the built-in ones.
+        try:
+            gorella.unpatch(['find', 'rfind', 'split'])
+            self.assertEqual(list('a b c'.isplit(' ')), ['a', 'b', 'c'])
+            self.assertEqual(list('a b c'.irsplit(' ', 1)), ['c', 'a b'])
+            self.assertRaises(ValueError, 'abc'.isplit, '')
+        finally:
+            gorella.patch()
+
+    def test_time_budget(self):
+        evil = re.compile(r'(a+)+$')
+        self.assertTrue(gorella.backtracking_risks(evil))
+        self.assertTrue(gorella.backtracking_risks(r'(\w+\s?)*x'))
+        self.assertEqual(gorella.backtracking_risks(r'(ab)+\d+'), [])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            gorella.prewarm([r'(x*)*y', r'x+y'])
+        self.assertEqual([w.category for w in caught],
+                         [gorella.BacktrackingWarning])
+        try:
+            self.assertRaises(gorella.RegexTimeout, gorella.call_with_timeout,
+                              'search', 'a' * 40 + '!', (evil,), timeout=0.2)
+            self.assertEqual(gorella.call_with_timeout(
+                'split', 'a1b', (re.compile(r'\d'),), timeout=5), ['a', 'b'])
+            with gorella.time_limit(5):
+                self.assertEqual('xay'.search('a').start(), 1)
+                self.assertEqual(list('a1b2'.isplit(re.compile(r'\d'))),
+                                 ['a', 'b', ''])
+                self.assertRaises(ValueError, 'xay'.index, re.compile('z'))
+                # Functions can't be pickled, the call is made in place.
+                self.assertEqual('a1b'.replace(re.compile(r'\d'),
+                                               lambda m: 'X'), 'aXb')
+                self.assertEqual('a1b'.replace(re.compile(r'\d'), 'Y'), 'aYb')
+                with gorella.time_limit(0.2):
+                    self.assertRaises(gorella.RegexTimeout, ('a' * 40 + '!').find,
+                                      evil)
+            self.assertTrue(str.__dict__['find'] is gorella.PatchClass.find)
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                self.assertEqual(loop.run_until_complete(gorella.call_async(
+                    'count', 'a1b22', (re.compile(r'\d'),), timeout=5)), 3)
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
+        finally:
+            gorella.get_worker().stop()
+        self.assertFalse(gorella._is_regex_call('endswith', (('.py', '.c'),),
+                                                {}))
+        self.assertTrue(gorella._is_regex_call('endswith', (('.py', evil),),
+                                               {}))
+        # The first limited call of a process starts the worker itself.
+        script = """if 1:
+            import gorella, re
+            with gorella.time_limit(0.5):
+                try:
+                    ('a' * 40 + '!').search(re.compile(r'(a+)+$'))
+                except gorella.RegexTimeout:
+                    print('timeout')
+        """
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         timeout=30)
+        self.assertEqual(output.decode().strip(), 'timeout')
+
+    def test_replace_rules(self):
+        s = 'call 555-1234 or mail bob@x.org (a.b)'
+        rules = [(re.compile(r'\d{3}-\d{4}'), '<phone>'),
+                 (re.compile(r'(\w+)@(\w+\.\w+)'), r'\2 at \1'),
+                 ('(a.b)', lambda m: m.group().upper()),
+                 ('a', 'A')]
+        self.assertEqual(s.replace(rules),
+                         'cAll <phone> or mAil x.org at bob (A.B)')
+        self.assertEqual(s.replace(rules, count=2),
+                         'cAll <phone> or mail bob@x.org (a.b)')
+        self.assertEqual('abc'.replace({'ab': '1', 'abc': '2'}), '1c')
+        self.assertEqual('abc'.replace([('abc', '2'), ('ab', '1')]), '2')
+        self.assertEqual('aab'.replace([(re.compile(r'(a)\1'), r'<\1>'),
+                                        ('b', 'B')]), '<a>B')
+        self.assertEqual('ab'.replace([(re.compile('x*'), '-')]), '-a-b-')
+        self.assertEqual(b'abc'.replace({b'b': b'B', re.compile(b'c'): b'C'}),
+                         b'aBC')
+        # Rules that can't be combined give the same results.
+        backref = (re.compile(r'(z)\1'), '')
+        rnd = random.Random(11)
+        pool = [(re.compile('a?'), '<>'), (re.compile('x'), ''),
+                (re.compile('b*'), '-'), (re.compile('ab|a'), '.'),
+                (re.compile(r'(?<=a)'), '^'), ('xa', 'X')]
+        for _ in range(200):
+            rules = rnd.sample(pool, rnd.randint(2, 4))
+            s = ''.join(rnd.choice('abxq') for _ in range(rnd.randint(0, 8)))
+            self.assertEqual(s.replace(rules + [backref]), s.replace(rules),
+                             (s, rules))
+        self.assertEqual('x'.replace([(re.compile('a?'), '<>'),
+                                      (re.compile('x'), ''), backref]),
+                         '<><>')
+        mixed = [('zzz', 'X'), (re.compile(r'\d'), 'N')]
+        self.assertIsNotNone(gorella.get_replace_rules(mixed).patterns.combined)
+        self.assertEqual(('a1zzz' * 3).replace(mixed), 'aNX' * 3)
+        self.assertEqual('ab'.replace('a', 'x'), 'xb')
+        self.assertRaises(TypeError, 'ab'.replace, {'a': 'b'}, 'c')
+        self.assertRaises(TypeError, 'abcd'.replace, ('ab', 'cd'))
+        self.assertRaises(TypeError, 'abcd'.replace, ['ab'])
+        self.assertEqual('abcd'.replace([['ab', 'X']]), 'Xcd')
+
+    def test_threads(self):
+        nums = re.compile(r'\d+')
+        gorella.prewarm([r'\d'])
+        errors = []
+
+        def call():
+            try:
+                for _ in range(300):
+                    self.assertEqual('a1b22'.find(nums), 1)
+                    self.assertEqual('a1b22'.findall(r'\d'), ['1', '2', '2'])
+            except Exception as e:
+                errors.append(e)
+
+        def toggle():
+            for _ in range(20):
+                gorella.unpatch(['isplit'], [bytes])
+                gorella.patch(['isplit'], [bytes])
+        gorella.stats.reset()
+        gorella.enable_stats()
+        try:
+            threads = [threading.Thread(target=call) for _ in range(4)] + \
+                [threading.Thread(target=toggle) for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            snapshot = gorella.stats.snapshot()
+        finally:
+            gorella.disable_stats()
+        self.assertEqual(errors, [])
+        self.assertEqual(snapshot['methods']['find']['calls'], 1200)
+        self.assertEqual(snapshot['methods']['findall']['calls'], 1200)
+        self.assertTrue(hasattr(bytes, 'isplit'))
+        self.assertIs(str.__dict__['find'], gorella.PatchClass.find)
+        # Patched functions looked up before an unpatch keep working.
+        startswith = str.__dict__['startswith']
+        bound = 'ab'.startswith
+        stop = threading.Event()
+
+        def check():
+            while not stop.is_set():
+                try:
+                    self.assertTrue('ab'.startswith(('a', 'b')))
+                    self.assertTrue(bound('a'))
+                except Exception as e:
+                    errors.append(e)
+                    return
+        threads = [threading.Thread(target=check) for _ in range(4)]
+        for t in threads:
+            t.start()
+        try:
+            for _ in range(50):
+                gorella.unpatch(['startswith'])
+                self.assertTrue(startswith('ab', 'a'))
+                gorella.patch(['startswith'])
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+        self.assertEqual(errors, [])
+
+    def test_grep(self):
+        rnd = random.Random(5)
+        for _ in range(50):
+            s = ''.join(rnd.choice('ab\n') for _ in range(
+                rnd.choice([0, 9, 500])))
+            for text, nl, source in ((s, '\n', 'a+|^'),
+                                     (s.encode(), b'\n', b'a+|^')):
+                pattern = re.compile(source, re.M)
+                expected = [(text.count(nl, 0, m.start()) + 1,
+                             m.start() - text.rfind(nl, 0, m.start()) - 1, m)
+                            for m in pattern.finditer(text)]
+                self.assertEqual([(l, c, m.span())
+                                  for l, c, m in text.grep(pattern)],
+                                 [(l, c, m.span()) for l, c, m in expected])
+        self.assertEqual([(l, c) for l, c, _ in 'A\nba'.grep('a', re.I)],
+                         [(1, 0), (2, 1)])
+        text = 'one\ntwo\n\nfour'
+        index = gorella.LineIndex(text)
+        self.assertEqual([index.line(n) for n in range(1, len(index) + 1)],
+                         ['one', 'two', '', 'four'])
+        self.assertEqual(index.position(len(text)), (4, 4))
+        self.assertRaises(IndexError, index.line, 5)
+        self.assertEqual([(l, c) for l, c, _ in text.grep('o', index=index)],
+                         [(1, 0), (2, 2), (4, 1)])
+        self.assertRaises(ValueError, 'one'.grep, 'o', index=index)
+        self.assertEqual(list(gorella.LineIndex(bytearray(b'a\nb\n')).starts),
+                         [0, 2, 4])
+
+    def test_span_cache(self):
+        rnd = random.Random(7)
+        cache = gorella.span_cache
+        patterns = [re.compile('aa'), re.compile('a*'), re.compile('b|ab'),
+                    re.compile(r'(?<=a)b'), re.compile('x'),
+                    re.compile(b'a+b')]
+        texts = [''.join(rnd.choice('ab') for _ in range(rnd.choice([8, 50])))
+                 for _ in range(20)]
+        queries = []
+        for text in texts:
+            for p in patterns:
+                if isinstance(p.pattern, bytes):
+                    text = text.encode()
+                for _ in range(10):
+                    start = rnd.randint(-2, len(text) + 2)
+                    end = rnd.choice([None, len(text), len(text) - 3])
+                    queries.append((text, p, start, end))
+
+        def answers():
+            rs = []
+            for text, p, start, end in queries:
+                rs.append((text.find(p, start, end), text.rfind(p, start, end),
+                           text.count(p, start, end), text.partition(p)))
+                for method in (text.index, text.rindex):
+                    try:
+                        rs.append(method(p, start, end))
+                    except ValueError:
+                        rs.append(None)
+            return rs
+        expected = answers()
+        cache.min_length, cache.maxbytes = 0, 10 ** 6
+        try:
+            cache.clear()
+            self.assertEqual(answers(), expected)
+            info = cache.info()
+            self.assertGreater(info['hits'], info['misses'])
+            self.assertGreater(info['hit_rate'], 0.5)
+            self.assertLessEqual(info['nbytes'], cache.maxbytes)
+            cache.resize(info['nbytes'] // 2)
+            self.assertLessEqual(cache.info()['nbytes'], cache.maxbytes)
+            self.assertGreater(cache.info()['evictions'], 0)
+            self.assertEqual(answers(), expected)
+            # Spans that don't fit are dropped, and not looked for again.
+            text, dense = 'ab' * 5000, re.compile('b')
+            cache.clear()
+            cache.resize(sys.getsizeof(text) + 100)
+            misses = cache.info()['misses']
+            for _ in range(3):
+                self.assertEqual(text.find(dense, 3), 3)
+                self.assertEqual(text.count(dense), 5000)
+            self.assertEqual(cache.info()['misses'], misses + 1)
+            self.assertEqual(cache.info()['size'], 0)
+            data = bytearray(b'aab')
+            self.assertEqual(data.find(re.compile(b'b')), 2)
+            data[0:0] = b'b'
+            self.assertEqual(data.find(re.compile(b'b')), 0)
+        finally:
+            cache.min_length, cache.maxbytes = 4096, 0
+            cache.clear()
+
+    def test_pattern_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        ends = gorella.compile(r'(?P<n>\d+)x*')
+        'a1x'.endswith(ends)
+        self.assertEqual(gorella.save_pattern_cache(
+            path, [('ab', re.I), ends, b'::', re.compile('-+$', re.M)]), 4)
+        script = """if 1:
+            import gorella, re
+            assert gorella.program_cache.records
+            ends = gorella.compile(r'(?P<n>\\d+)x*')
+            assert ends == re.compile(r'(?P<n>\\d+)x*')
+            assert ends.groupindex == {'n': 1}
+            ops = gorella.get_pattern_ops(ends)
+            assert ops._reversed and ops._anchored is None
+            assert 'a1x'.endswith(ends) and not 'a1xa'.endswith(ends)
+            assert gorella.compile('ab', re.I).search('xAB').start() == 1
+            assert gorella.get_pattern_ops(gorella.compile(b'::')).literal
+            assert gorella.get_pattern_ops(re.compile('-+$', re.M))._widths
+            assert b'a::b'.split(gorella.compile(b'::')) == [b'a', b'b']
+            print(gorella.pattern_cache.info()['misses'])
+        """
+        env = dict(os.environ, GORELLA_PATTERN_FILE=path)
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         env=env)
+        self.assertEqual(output.decode().strip(), '3')
+        with open(path, 'r+b') as f:
+            f.seek(len(gorella.PROGRAMS_MAGIC) + 8 + 4)
+            f.write(b'\xff')
+        self.assertEqual(gorella.load_pattern_cache(path), 0)
+        self.assertEqual(gorella.program_cache.records, {})
+        self.assertEqual(gorella.load_pattern_cache(path + '.missing'), 0)
+
+    def test_builtin_fallback(self):
+        self.assertIs(gorella.get_builtin_method(str, 'find'), str._c_find)
+
+        class Text(str):
+            pass
+
+        self.assertEqual(Text('hello world').find('o'), 4)
+        self.assertEqual(Text('hello world').split(' '), ['hello', 'world'])
+
 
 if __name__ == '__main__':
     unittest.main()